@@ -0,0 +1,293 @@
+# -*- coding:utf-8 -*-
+"""Load test of the query classes against the local mock ThreatBook server.
+
+Every mode runs a number of lookups against a MockServer and reports the
+throughput, the p50 and p99 latency of a lookup and the memory held per
+result. The results can be saved with --output and compared with a saved
+baseline with --baseline, which makes the run fail on a regression:
+
+    python benchmarks/bench.py --output baseline.json
+    python benchmarks/bench.py --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from threatbook_api.cache import MemoryCache  # noqa: E402
+from threatbook_api.client import Client  # noqa: E402
+from threatbook_api.domain_analysis_query import DomainAnalysis  # noqa: E402
+from threatbook_api.file_analysis_query import Report  # noqa: E402
+from threatbook_api.ip_analysis_query import IpAnalysis  # noqa: E402
+from threatbook_api.ip_reputation_query import IpReputation  # noqa: E402
+from threatbook_api.mockserver import MockServer  # noqa: E402
+from threatbook_api.retry import Retry  # noqa: E402
+
+API_KEY = "benchmark"
+
+
+def ips(n, unique=None):
+    unique = unique or n
+    return ["10.%d.%d.%d" % (i // 65536 % 256, i // 256 % 256, i % 256) for i in (j % unique for j in range(n))]
+
+
+def domains(n):
+    return ["host%d.example.com" % i for i in range(n)]
+
+
+def hashes(n):
+    return ["%064x" % i for i in range(n)]
+
+
+class ServerProcess(object):
+    """A MockServer run by another interpreter, so that it does not share the GIL of the client."""
+
+    def __init__(self, args):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.url = "http://127.0.0.1:%d" % port
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "threatbook_api.mockserver", "--port", str(port), "--latency", str(args.latency),
+             "--jitter", str(args.jitter), "--error-rate", str(args.error_rate), "--size", str(args.size),
+             "--seed", "0"], stdout=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    self.process.kill()
+                    raise
+                time.sleep(0.05)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.process.terminate()
+        self.process.wait()
+
+
+def make_client(server, args, cache=None):
+    return Client(pool_maxsize=args.workers, base_url=server.url, cache=cache,
+                  retry=Retry(backoff=0.01, max_backoff=0.1, jitter=False))
+
+
+def ip_mode(server, args):
+    client = make_client(server, args)
+    return IpAnalysis(API_KEY, client=client).get_all, ips(args.requests), client
+
+
+def typed_ip_mode(server, args):
+    client = make_client(server, args)
+    return IpAnalysis(API_KEY, client=client, typed=True).get_all, ips(args.requests), client
+
+
+def cached_ip_mode(server, args):
+    client = make_client(server, args, cache=MemoryCache())
+    return IpAnalysis(API_KEY, client=client).get_all, ips(args.requests, max(1, args.requests // 10)), client
+
+
+def domain_mode(server, args):
+    client = make_client(server, args)
+    return DomainAnalysis(API_KEY, client=client).get_all, domains(args.requests), client
+
+
+def report_mode(server, args):
+    client = make_client(server, args)
+    return Report(API_KEY, client=client).get_report, hashes(max(1, args.requests // 10)), client
+
+
+def reputation_mode(server, args):
+    # One lookup is a batch of 10 IPs.
+    client = make_client(server, args)
+    reputation = IpReputation(API_KEY, client=client)
+    batches = [",".join(ips(args.requests)[i:i + 10]) for i in range(0, args.requests, 10)]
+    return reputation.get_all, batches, client
+
+
+MODES = {
+    "ip": ip_mode,
+    "ip-typed": typed_ip_mode,
+    "ip-cached": cached_ip_mode,
+    "domain": domain_mode,
+    "report": report_mode,
+    "reputation": reputation_mode,
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def measure_memory(func, indicators, count):
+    """Return the number of bytes held per result of count lookups."""
+    indicators = indicators[:count]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    results = [func(indicator) for indicator in indicators]
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del results
+    return held / float(max(1, len(indicators)))
+
+
+def run_mode(name, server, args):
+    func, indicators, client = MODES[name](server, args)
+    latencies = []
+
+    def timed(indicator):
+        start = time.perf_counter()
+        func(indicator)
+        latencies.append(time.perf_counter() - start)
+
+    try:
+        # One untimed pass over a few indicators opens the pooled connections.
+        for indicator in indicators[:args.workers]:
+            func(indicator)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(timed, indicators))
+        elapsed = time.perf_counter() - start
+        memory = measure_memory(func, indicators, args.memory_lookups)
+    finally:
+        client.close()
+    return stats(name, latencies, elapsed, memory)
+
+
+def run_async_mode(server, args):
+    try:
+        from threatbook_api.aio import AsyncClient, AsyncIpAnalysis
+        AsyncClient(base_url=server.url)
+    except ImportError:
+        return None
+
+    async def main():
+        client = AsyncClient(concurrency=args.workers, base_url=server.url,
+                             retry=Retry(backoff=0.01, max_backoff=0.1, jitter=False))
+        analysis = AsyncIpAnalysis(API_KEY, client=client)
+        latencies = []
+        # As many lookups in flight as the threads of the other modes.
+        workers = asyncio.Semaphore(args.workers)
+
+        async def timed(indicator):
+            async with workers:
+                begin = time.perf_counter()
+                await analysis.get_all(indicator)
+                latencies.append(time.perf_counter() - begin)
+
+        indicators = ips(args.requests)
+        await asyncio.gather(*[analysis.get_all(ip) for ip in indicators[:args.workers]])
+        start = time.perf_counter()
+        await asyncio.gather(*[timed(ip) for ip in indicators])
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        results = [await analysis.get_all(ip) for ip in indicators[:args.memory_lookups]]
+        memory = (tracemalloc.get_traced_memory()[0] - before) / float(max(1, len(results)))
+        tracemalloc.stop()
+        await client.close()
+        return stats("ip-async", latencies, elapsed, memory)
+
+    return asyncio.run(main())
+
+
+def stats(name, latencies, elapsed, memory):
+    return {
+        "mode": name,
+        "lookups": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "memory_per_result": memory,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against a baseline, as a list of messages."""
+    previous = {item["mode"]: item for item in baseline}
+    regressions = []
+    for item in results:
+        old = previous.get(item["mode"])
+        if old is None:
+            continue
+        if item["throughput"] < old["throughput"] * (1 - tolerance):
+            regressions.append("%s: throughput %.1f/s, baseline %.1f/s"
+                               % (item["mode"], item["throughput"], old["throughput"]))
+        if item["p99_ms"] > old["p99_ms"] * (1 + tolerance):
+            regressions.append("%s: p99 %.1fms, baseline %.1fms" % (item["mode"], item["p99_ms"], old["p99_ms"]))
+        if item["memory_per_result"] > old["memory_per_result"] * (1 + tolerance) + 1024:
+            regressions.append("%s: %.0f bytes per result, baseline %.0f"
+                               % (item["mode"], item["memory_per_result"], old["memory_per_result"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--modes", default=",".join(list(MODES) + ["ip-async"]),
+                        help="comma separated modes, among %s and ip-async" % ", ".join(MODES))
+    parser.add_argument("-n", "--requests", type=int, default=2000, help="number of lookups per mode")
+    parser.add_argument("-w", "--workers", type=int, default=16, help="number of concurrent lookups")
+    parser.add_argument("--latency", type=float, default=0.005, help="latency of the mock server in seconds")
+    parser.add_argument("--jitter", type=float, default=0.005, help="random latency added by the mock server")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the requests failing")
+    parser.add_argument("--size", type=int, default=10, help="number of items of the lists of the responses")
+    parser.add_argument("--memory-lookups", type=int, default=200, help="number of results held to measure memory")
+    parser.add_argument("-o", "--output", help="save the results as json to this file")
+    parser.add_argument("--baseline", help="json results of a previous run to compare with")
+    parser.add_argument("--in-process", action="store_true",
+                        help="run the mock server in a thread of the benchmark instead of another process")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression against the baseline")
+    args = parser.parse_args(argv)
+
+    results = []
+    if args.in_process:
+        server = MockServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, size=args.size,
+                            seed=0)
+    else:
+        server = ServerProcess(args)
+    with server:
+        for name in args.modes.split(","):
+            if name == "ip-async":
+                result = run_async_mode(server, args)
+                if result is None:
+                    print("ip-async skipped, aiohttp is not installed", file=sys.stderr)
+                    continue
+            else:
+                result = run_mode(name, server, args)
+            results.append(result)
+            print("%-12s %8d lookups %10.1f/s  p50 %7.2fms  p99 %7.2fms  %9.0f bytes/result" % (
+                result["mode"], result["lookups"], result["throughput"], result["p50_ms"], result["p99_ms"],
+                result["memory_per_result"]))
+        if args.in_process:
+            print("mock server: %d requests, %d errors" % (server.requests, server.errors))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print("REGRESSION " + message, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,5 +14,8 @@ setup(
     long_description=io.open('README.rst',encoding='UTF-8').read(),
     license = "MIT Licence",
     packages=find_packages(),
-    install_requires = ["requests"]
+    install_requires = ["requests"],
+    extras_require = {"async": ["aiohttp"], "fast": ["orjson"], "prometheus": ["prometheus_client"],
+                      "otel": ["opentelemetry-api"]},
+    entry_points = {"console_scripts": ["threatbook-enrich=threatbook_api.cli:main"]}
 )
\ No newline at end of file
@@ -0,0 +1,514 @@
+# -*- coding:utf-8 -*-
+"""Asyncio counterparts of the query classes.
+
+Every class here has the same methods and return values as its blocking
+counterpart, but the methods are coroutines sent through an AsyncClient built
+on aiohttp. Install the optional dependency with ``pip install threatbook_api[async]``.
+"""
+import asyncio
+import io
+import os
+import time
+from collections import deque
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from threatbook_api.client import rebase
+from threatbook_api.decoder import loads
+from threatbook_api.domain_analysis_query import ENDPOINTS as DOMAIN_ENDPOINTS
+from threatbook_api.email_analysis_query import ENDPOINT as EMAIL_ENDPOINT
+from threatbook_api.endpoints import call_async, failed
+from threatbook_api.file_analysis_query import (ENDPOINTS as REPORT_ENDPOINTS, FETCH_FILE_ENDPOINT, UPLOAD_ENDPOINT,
+                                                merge_sections)
+from threatbook_api.instrument import HIT, MISS, RequestEvent, make_hooks
+from threatbook_api.ioc_query import ENDPOINT as IOC_ENDPOINT
+from threatbook_api.ip_analysis_query import ENDPOINTS as IP_ENDPOINTS, URL as IP_URL
+from threatbook_api.ip_reputation_query import (ENDPOINTS as IP_REPUTATION_ENDPOINTS, URL as IP_REPUTATION_URL,
+                                                VIEWS, batch_ips, split_reputation)
+from threatbook_api.multipart import CHUNK_SIZE, MultipartStream, hash_file
+from threatbook_api.ratelimit import NORMAL
+from threatbook_api.result import encode
+from threatbook_api.retry import Retry
+from threatbook_api.singleflight import AsyncSingleFlight, flight_key
+
+class AsyncResponse(object):
+    """The body and status of a finished request, read completely before it is returned."""
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return loads(self.content)
+
+
+class AsyncClient(object):
+    """Non-blocking HTTP layer shared by the async query classes.
+
+    The client keeps one aiohttp session whose connector reuses keep-alive
+    connections, and a semaphore that bounds the number of requests in flight,
+    so any number of lookups can be awaited at once from one event loop.
+
+    Attributes:
+        :param concurrency: The maximum number of requests in flight at the same time.
+        :param limit: The maximum number of open connections of the pool.
+        :param limit_per_host: The maximum number of open connections per host, 0 is no limit.
+        :param timeout: Default total timeout of a request in seconds.
+        :param cache: A cache such as MemoryCache, see Client.
+        :param single_flight: Whether identical requests awaited at the same time
+            share one request, see Client. The default is True.
+        :param rate_limiter: A RateLimiter, see Client.
+        :param priority: The priority of the requests for the daily quota, see Client.
+        :param retry: The Retry policy of the requests, see Client.
+        :param base_url: A scheme and host to which all the requests are sent, see Client.
+        :param hooks: Instrumentation hooks, see Client. The dns and connect phases are
+            timed separately from the server phase.
+    """
+
+    def __init__(self, concurrency=100, limit=100, limit_per_host=0, timeout=30, cache=None, single_flight=True,
+                 rate_limiter=None, priority=NORMAL, retry=None, base_url=None, hooks=None):
+        if aiohttp is None:
+            raise ImportError("AsyncClient requires aiohttp, install it with pip install aiohttp")
+        self.concurrency = concurrency
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.cache = cache
+        self.single_flight = AsyncSingleFlight() if single_flight else None
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+        self.retry = retry if retry is not None else Retry()
+        self.base_url = base_url
+        self.hooks = make_hooks(hooks)
+        self._session = None
+        self._semaphore = None
+        self._loop = None
+
+    def _get_session(self):
+        # A session and a semaphore belong to the event loop that created them.
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            trace_configs = [_trace_config()] if self.hooks is not None else None
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                                  trace_configs=trace_configs)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+        return self._session
+
+    async def request(self, method, url, **kwargs):
+        """Send a request and read its whole body, or answer it from the cache."""
+        url = rebase(url, self.base_url)
+        if self.hooks is None:
+            return await self._request(method, url, kwargs, None)
+        event = RequestEvent(method, url, self.hooks)
+        self.hooks.before_request(event)
+        try:
+            response = await self._request(method, url, kwargs, event)
+        except Exception as e:
+            event.finish(error=e)
+            self.hooks.after_request(event)
+            raise
+        event.finish(response)
+        self.hooks.after_request(event)
+        return response
+
+    async def _request(self, method, url, kwargs, event):
+        params = kwargs.get("params") or kwargs.get("data")
+        if not isinstance(params, dict):
+            return await self._send(method, url, event, **kwargs)
+        if self.cache is not None:
+            response = self.cache.lookup(method, url, params)
+            if event is not None:
+                event.cache = MISS if response is None else HIT
+            if response is not None:
+                return response
+        if self.single_flight is None:
+            return await self._send_and_store(method, url, params, kwargs, event)
+        key = flight_key(method, url, params)
+        return await self.single_flight.do(key, lambda: self._send_and_store(method, url, params, kwargs, event))
+
+    async def _send_and_store(self, method, url, params, kwargs, event=None):
+        response = await self.retry.call_async(lambda: self._send(method, url, event, **kwargs))
+        if self.cache is not None:
+            self.cache.store(method, url, params, response)
+        return response
+
+    async def _send(self, method, url, event=None, **kwargs):
+        if event is not None:
+            event.attempts += 1
+            start = time.perf_counter()
+        if self.rate_limiter is not None:
+            params = kwargs.get("params") or kwargs.get("data")
+            api_key = params.get("apikey") if isinstance(params, dict) else None
+            await self.rate_limiter.acquire_async(api_key, url, self.priority)
+        session = self._get_session()
+        timeout = kwargs.pop("timeout", None)
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        if event is not None:
+            event.add("throttle", time.perf_counter() - start)
+            kwargs["trace_request_ctx"] = event
+        async with self._semaphore:
+            async with session.request(method, url, **kwargs) as response:
+                if event is not None:
+                    received = time.perf_counter()
+                content = await response.read()
+                if event is not None:
+                    event.add("download", time.perf_counter() - received)
+                return AsyncResponse(response.status, content, response.headers)
+
+    async def get(self, url, params=None, **kwargs):
+        return await self.request("GET", url, params=params, **kwargs)
+
+    async def post(self, url, data=None, **kwargs):
+        return await self.request("POST", url, data=data, **kwargs)
+
+    async def close(self):
+        """Close all the pooled connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+def _trace_config():
+    """Return an aiohttp TraceConfig adding the dns, connect and server phases to the event of a request."""
+    trace_config = aiohttp.TraceConfig()
+
+    def phase(name, end=False):
+        async def callback(session, context, params):
+            event = context.trace_request_ctx
+            if not isinstance(event, RequestEvent):
+                return
+            if end:
+                started = getattr(context, name, None)
+                if started is not None:
+                    event.add(name, time.perf_counter() - started)
+            else:
+                setattr(context, name, time.perf_counter())
+        return callback
+
+    trace_config.on_dns_resolvehost_start.append(phase("dns"))
+    trace_config.on_dns_resolvehost_end.append(phase("dns", True))
+    trace_config.on_connection_create_start.append(phase("connect"))
+    trace_config.on_connection_create_end.append(phase("connect", True))
+    trace_config.on_request_headers_sent.append(phase("server"))
+    trace_config.on_request_end.append(phase("server", True))
+    return trace_config
+
+
+_default_client = None
+
+
+def get_default_async_client():
+    """Return the process-wide client shared by async query objects created without one."""
+    global _default_client
+    if _default_client is None:
+        _default_client = AsyncClient()
+    return _default_client
+
+
+class _AsyncQuery(object):
+
+    def __init__(self, api_key, client=None, typed=False):
+        self.api_key = api_key
+        self.client = client if client is not None else get_default_async_client()
+        self.typed = typed
+        self.response_code = -4
+
+
+class AsyncDomainAnalysis(_AsyncQuery):
+    """Async counterpart of DomainAnalysis."""
+
+    async def get_fields(self, domain, fields):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_fields"], domain, fields)
+
+    async def get_all(self, domain):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_all"], domain)
+
+    async def get_history_whoises(self, domain):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_history_whoises"], domain)
+
+    async def get_cur_whois(self, domain):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_cur_whois"], domain)
+
+    async def get_history_ips(self, domain):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_history_ips"], domain)
+
+    async def get_cur_ips(self, domain):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_cur_ips"], domain)
+
+    async def get_tags(self, domain):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_tags"], domain)
+
+    async def get_judgments(self, domain):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_judgments"], domain)
+
+    async def get_intelligences(self, domain):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_intelligences"], domain)
+
+    async def get_samples(self, domain):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_samples"], domain)
+
+    async def get_domain_4_email(self, domain):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_domain_4_email"], domain)
+
+    async def get_sub_domains(self, domain):
+        return await call_async(self, DOMAIN_ENDPOINTS["get_sub_domains"], domain)
+
+
+class AsyncIpAnalysis(_AsyncQuery):
+    """Async counterpart of IpAnalysis."""
+
+    def __init__(self, api_key, client=None, typed=False, clean_ports=True):
+        super(AsyncIpAnalysis, self).__init__(api_key, client, typed)
+        self.url = IP_URL
+        self.clean_ports = clean_ports
+
+    async def get_all(self, ip):
+        return await call_async(self, IP_ENDPOINTS["get_all"], ip)
+
+    async def get_ip(self, ip):
+        return await call_async(self, IP_ENDPOINTS["get_ip"], ip)
+
+    async def get_tags(self, ip):
+        return await call_async(self, IP_ENDPOINTS["get_tags"], ip)
+
+    async def get_judgments(self, ip):
+        return await call_async(self, IP_ENDPOINTS["get_judgments"], ip)
+
+    async def get_intelligences(self, ip):
+        return await call_async(self, IP_ENDPOINTS["get_intelligences"], ip)
+
+    async def get_samples(self, ip):
+        return await call_async(self, IP_ENDPOINTS["get_samples"], ip)
+
+    async def get_cur_domains(self, ip):
+        return await call_async(self, IP_ENDPOINTS["get_cur_domains"], ip)
+
+    async def get_history_domains(self, ip):
+        return await call_async(self, IP_ENDPOINTS["get_history_domains"], ip)
+
+    async def get_port(self, ip):
+        return await call_async(self, IP_ENDPOINTS["get_port"], ip)
+
+    async def get_fields(self, ip, fields):
+        return await call_async(self, IP_ENDPOINTS["get_fields"], ip, fields)
+
+
+class AsyncIpReputation(_AsyncQuery):
+    """Async counterpart of IpReputation."""
+
+    def __init__(self, api_key, client=None, typed=False):
+        super(AsyncIpReputation, self).__init__(api_key, client, typed)
+        self.url = IP_REPUTATION_URL
+
+    async def get_all(self, ip):
+        return await call_async(self, IP_REPUTATION_ENDPOINTS["get_all"], ip)
+
+    async def get_now(self, ip):
+        return await call_async(self, IP_REPUTATION_ENDPOINTS["get_now"], ip)
+
+    async def get_expired(self, ip):
+        return await call_async(self, IP_REPUTATION_ENDPOINTS["get_expired"], ip)
+
+    async def get_many(self, ips, view="now", max_workers=4):
+        """Async generator of (ip, result) tuples, see IpReputation.get_many."""
+        if view not in VIEWS:
+            raise ValueError("view must be one of %s" % ", ".join(VIEWS))
+        pending = deque()
+        try:
+            for batch in batch_ips(ips):
+                pending.append((batch, asyncio.ensure_future(self.get_all(",".join(batch)))))
+                if len(pending) > max_workers:
+                    batch, task = pending.popleft()
+                    for item in split_reputation(batch, await task, view):
+                        yield item
+            while pending:
+                batch, task = pending.popleft()
+                for item in split_reputation(batch, await task, view):
+                    yield item
+        finally:
+            for batch, task in pending:
+                task.cancel()
+
+
+class AsyncIoc(_AsyncQuery):
+    """Async counterpart of Ioc."""
+
+    async def get_ioc(self, q):
+        return await call_async(self, IOC_ENDPOINT, q)
+
+
+class AsyncEmail(_AsyncQuery):
+    """Async counterpart of Email."""
+
+    async def get_email(self, email):
+        return await call_async(self, EMAIL_ENDPOINT, email)
+
+
+async def _read_chunks(body, chunk_size=CHUNK_SIZE):
+    # The file is read in the default executor, so a slow disk does not block the event loop.
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, body.read, chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class AsyncUpload(object):
+    """Async counterpart of Upload."""
+
+    def __init__(self, api_key, sandbox_type="win7_sp1_enx86_office2013", run_time=60, file_path=os.path.abspath("."),
+                 client=None, typed=False, known_hashes=None):
+        self.api_key = api_key
+        self.sandbox_type = sandbox_type
+        self.run_time = run_time
+        self.path = file_path
+        self.client = client if client is not None else get_default_async_client()
+        self.typed = typed
+        self.known_hashes = known_hashes
+        self.response_code = -4
+
+    async def upload_file(self, file, filename=None, skip_analyzed=False):
+        """See Upload.upload_file. The file is streamed in chunks read in a thread."""
+        if isinstance(file, (bytes, bytearray)):
+            return await self._upload(io.BytesIO(file), filename or "sample", skip_analyzed)
+        if hasattr(file, "read"):
+            name = getattr(file, "name", None)
+            if not isinstance(name, str):
+                name = "sample"
+            return await self._upload(file, filename or os.path.basename(name), skip_analyzed)
+        with open(os.path.join(self.path, file), "rb") as f:
+            return await self._upload(f, filename or file, skip_analyzed)
+
+    async def _upload(self, fileobj, filename, skip_analyzed):
+        sha256 = None
+        if skip_analyzed or (self.known_hashes is not None and getattr(fileobj, "seekable", lambda: False)()):
+            sha256 = await asyncio.get_running_loop().run_in_executor(None, hash_file, fileobj)
+        if sha256 is not None and self.known_hashes is not None and sha256 in self.known_hashes:
+            return self._analyzed(sha256)
+        if skip_analyzed:
+            report = AsyncReport(self.api_key, self.sandbox_type, self.run_time, client=self.client,
+                                 known_hashes=self.known_hashes)
+            summary = await report.get_summary(sha256)
+            if isinstance(summary, dict) and summary.get("response_code") == 0:
+                return self._analyzed(sha256)
+        fields = {
+            "apikey": self.api_key,
+            "sandbox_type": self.sandbox_type,
+            "run_time": self.run_time
+        }
+        body = MultipartStream(fields, "file", filename, fileobj)
+        headers = {"Content-Type": body.content_type}
+        try:
+            headers["Content-Length"] = str(len(body))
+        except TypeError:
+            pass
+        try:
+            response = await self.client.post(UPLOAD_ENDPOINT.url, data=_read_chunks(body), headers=headers)
+        except Exception as e:
+            return failed(UPLOAD_ENDPOINT, e, self.typed)
+        return UPLOAD_ENDPOINT.finish(self, response, body.sha256)
+
+    def _analyzed(self, sha256):
+        res = {"data": {"sha256": sha256}, "msg": "already analyzed", "response_code": 0}
+        return encode(res, self.typed, 200) if self.typed else res
+
+
+class AsyncReport(_AsyncQuery):
+    """Async counterpart of Report."""
+
+    def __init__(self, api_key, sandbox_type="win7_sp1_enx86_office2013", run_time=60, client=None, typed=False,
+                 known_hashes=None):
+        super(AsyncReport, self).__init__(api_key, client, typed)
+        self.sandbox_type = sandbox_type
+        self.run_time = run_time
+        self.known_hashes = known_hashes
+
+    async def get_report(self, sha256):
+        return await call_async(self, REPORT_ENDPOINTS["get_report"], sha256)
+
+    async def get_summary(self, sha256):
+        return await call_async(self, REPORT_ENDPOINTS["get_summary"], sha256)
+
+    async def get_ioc(self, sha256):
+        return await call_async(self, REPORT_ENDPOINTS["get_ioc"], sha256)
+
+    async def get_system(self, sha256):
+        return await call_async(self, REPORT_ENDPOINTS["get_system"], sha256)
+
+    async def get_network(self, sha256):
+        return await call_async(self, REPORT_ENDPOINTS["get_network"], sha256)
+
+    async def get_signature(self, sha256):
+        return await call_async(self, REPORT_ENDPOINTS["get_signature"], sha256)
+
+    async def get_static(self, sha256):
+        return await call_async(self, REPORT_ENDPOINTS["get_static"], sha256)
+
+    async def get_dropped(self, sha256):
+        return await call_async(self, REPORT_ENDPOINTS["get_dropped"], sha256)
+
+    async def get_pstree(self, sha256):
+        return await call_async(self, REPORT_ENDPOINTS["get_pstree"], sha256)
+
+    async def get_multiengines(self, sha256):
+        return await call_async(self, REPORT_ENDPOINTS["get_multiengines"], sha256)
+
+    async def get_fields(self, sha256, fields):
+        func_dict = {
+            'summary': self.get_report,
+            'ioc': self.get_ioc,
+            'system': self.get_system,
+            'network': self.get_network,
+            'signature': self.get_signature,
+            'static': self.get_static,
+            'dropped': self.get_dropped,
+            'pstree': self.get_pstree,
+            'multiengines': self.get_multiengines
+        }
+        funcs = [func_dict[field] for field in fields.split(',') if field in func_dict]
+        results = await asyncio.gather(*[func(sha256) for func in funcs])
+        return merge_sections(results, self.typed)
+
+
+class AsyncFetchFile(_AsyncQuery):
+    """Async counterpart of FetchFile."""
+
+    async def get_all(self, resource):
+        return await call_async(self, FETCH_FILE_ENDPOINT, resource)
+
+    async def get_legallssuer(self, resource):
+        data0 = await self.get_all(resource)
+        if data0["response_code"] == 1:
+            data1 = data0.get("LegalIssuer", {})
+            res = {"LegalIssuer": data1, "msg": "", "response_code": 0}
+            return res
+        else:
+            return data0
+
+    async def get_cas(self, resource):
+        data0 = await self.get_all(resource)
+        if data0["response_code"] == 1:
+            data1 = data0.get("cas", {})
+            res = {"cas": data1, "msg": "", "response_code": 0}
+            return res
+        else:
+            return data0
@@ -0,0 +1,369 @@
+# -*- coding:utf-8 -*-
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from urllib.parse import urlencode, urlparse
+
+from threatbook_api.decoder import loads
+
+# Time to live in seconds of the cached responses, by path prefix of the endpoint.
+# Reputation changes quickly, whois and sandbox reports hardly ever do.
+DEFAULT_TTLS = {
+    "/api/v2/ip_reputation": 300,
+    "/api/v1/dns": 600,
+    "/api/v1/ip/query": 3600,
+    "/api/v1/domain/query": 6 * 3600,
+    "/api/v1/domain4email/query": 24 * 3600,
+    "/api/v1/file/fetch_file_legal_ca": 7 * 24 * 3600,
+    "/api/v2/file/report": 24 * 3600,
+}
+
+# The endpoints of the immutable results cached on disk by default: sandbox
+# reports and certificate chains, both keyed by sha256.
+DISK_ENDPOINTS = ("/api/v2/file/report", "/api/v1/file/fetch_file_legal_ca")
+
+_RESPONSE_CODE = re.compile(br'"response_code"\s*:\s*(-?\d+)')
+
+
+class CachedResponse(object):
+    """A response served from a cache, with the attributes the query classes read."""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return loads(self.content)
+
+
+def cache_key(method, url, params):
+    """Return the key and the field set of a request.
+
+    The key is made of the method, the url and the parameters except the apikey
+    and the field list, so the same indicator queried with different fields
+    shares one key. The fields are returned separately as a frozenset, or None
+    when the request has no field parameter.
+    """
+    params = dict(params or {})
+    params.pop("apikey", None)
+    field = params.pop("field", None)
+    fields = frozenset(item for item in field.split(",") if item) if field else None
+    key = "%s %s?%s" % (method, url, urlencode(sorted(params.items())))
+    return key, fields
+
+
+def is_cacheable(response):
+    """A response is cached when the HTTP request and the query both succeeded."""
+    if response.status_code != 200:
+        return False
+    match = _RESPONSE_CODE.search(response.content)
+    return match is not None and int(match.group(1)) >= 0
+
+
+def covers(cached_fields, fields):
+    """Whether a response fetched with cached_fields answers a request for fields."""
+    if cached_fields is None:
+        return fields is None
+    return fields is not None and fields <= cached_fields
+
+
+class BaseCache(object):
+    """Common part of the cache backends.
+
+    The Client calls lookup before a request and store after it. Subclasses only
+    implement get and set on keys built by cache_key.
+
+    Attributes:
+        :param ttl: The default time to live in seconds.
+        :param ttls: The time to live by path prefix of the endpoint.
+        :param endpoints: The path prefixes of the endpoints cached by this backend,
+            None for all of them.
+    """
+
+    def __init__(self, ttl, ttls=None, endpoints=None):
+        self.ttl = ttl
+        self.ttls = {} if ttls is None else ttls
+        self.endpoints = endpoints
+        self.hits = 0
+        self.misses = 0
+        self._count_lock = threading.Lock()
+
+    def accepts(self, url):
+        if self.endpoints is None:
+            return True
+        path = urlparse(url).path
+        return any(path.startswith(prefix) for prefix in self.endpoints)
+
+    def ttl_for(self, url):
+        """Return the time to live of the endpoint, matched by the longest path prefix."""
+        path = urlparse(url).path
+        best = None
+        for prefix in self.ttls:
+            if path.startswith(prefix) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        return self.ttl if best is None else self.ttls[best]
+
+    def lookup(self, method, url, params):
+        """Return the cached response of a request, or None."""
+        if not self.accepts(url):
+            return None
+        key, fields = cache_key(method, url, params)
+        response = self.get(key, fields)
+        with self._count_lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def store(self, method, url, params, response):
+        """Cache the response of a request if it succeeded."""
+        if self.accepts(url) and is_cacheable(response):
+            key, fields = cache_key(method, url, params)
+            self.set(key, fields, CachedResponse(response.status_code, response.content), self.ttl_for(url))
+
+    def get(self, key, fields=None):
+        raise NotImplementedError
+
+    def set(self, key, fields, response, ttl):
+        raise NotImplementedError
+
+    def stats(self):
+        """Return the hits and misses of the cache."""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class MemoryCache(BaseCache):
+    """In-memory response cache with LRU eviction and a time to live per endpoint.
+
+    A cached response answers later requests for the same endpoint and indicator
+    whose fields are a subset of the cached ones, so a cached get_all also
+    serves get_tags of the same IP or domain. The counters of hits and misses
+    are kept in the hits and misses attributes.
+
+    Attributes:
+        :param maxsize: The maximum number of cached responses.
+        :param ttl: The default time to live in seconds.
+        :param ttls: The time to live by path prefix of the endpoint, the
+            default is DEFAULT_TTLS.
+        :param endpoints: The path prefixes of the endpoints to cache, None for all.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300, ttls=None, endpoints=None):
+        super(MemoryCache, self).__init__(ttl, DEFAULT_TTLS if ttls is None else ttls, endpoints)
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, fields=None):
+        """Return the cached response of the key covering the fields, or None."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, cached_fields, response = entry
+            if expires < time.time():
+                del self._data[key]
+                return None
+            if not covers(cached_fields, fields):
+                return None
+            self._data.move_to_end(key)
+            return response
+
+    def set(self, key, fields, response, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, fields, response)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Return the hits, misses and current size of the cache."""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+class SQLiteCache(BaseCache):
+    """Response cache in a SQLite file, shared by all the processes of a host.
+
+    The bodies are stored zlib compressed. When the total size of the stored
+    bodies grows over max_bytes, the least recently used responses are deleted
+    until it is below 90% of it. The total is kept in a row updated in the
+    transaction of every change, so a write does not scan the table. The
+    database runs in WAL mode so that readers in other processes are not
+    blocked by a writer, and a hit only records its access time once per
+    touch_interval, in batches, so that most reads write nothing.
+
+    Attributes:
+        :param path: The path of the database file, created if it does not exist.
+        :param max_bytes: The maximum total size of the compressed bodies.
+        :param ttl: The default time to live in seconds, 30 days by default.
+        :param ttls: The time to live by path prefix of the endpoint.
+        :param endpoints: The path prefixes of the endpoints to cache, the default is
+            DISK_ENDPOINTS. Pass None to cache all of them.
+        :param level: The zlib compression level.
+        :param touch_interval: The number of seconds after which a hit updates the
+            access time of a response used by the LRU eviction.
+        :param touch_batch: The number of access times kept in memory before they
+            are written, they are also written with the next set.
+    """
+
+    def __init__(self, path, max_bytes=1024 ** 3, ttl=30 * 24 * 3600, ttls=None, endpoints=DISK_ENDPOINTS,
+                 level=6, touch_interval=60, touch_batch=100):
+        super(SQLiteCache, self).__init__(ttl, ttls, endpoints)
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.level = level
+        self.touch_interval = touch_interval
+        self.touch_batch = touch_batch
+        self._local = threading.local()
+        self._touched = {}
+        self._touch_lock = threading.Lock()
+        self._flushed = time.time()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, fields TEXT, status INTEGER, "
+                         "body BLOB, size INTEGER, expires REAL, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+            # A database created before the meta table gets its total once.
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('bytes', (SELECT COALESCE(SUM(size), 0) FROM cache))")
+
+    def _connect(self):
+        # sqlite3 connections must not be shared between threads.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, fields=None):
+        """Return the cached response of the key covering the fields, or None."""
+        conn = self._connect()
+        row = conn.execute("SELECT fields, status, body, expires, accessed FROM cache WHERE key = ?",
+                           (key,)).fetchone()
+        if row is None:
+            return None
+        cached_fields, status, body, expires, accessed = row
+        now = time.time()
+        if expires < now:
+            with conn:
+                # The condition is checked again, another process may have stored it since.
+                self._delete(conn, "key = ? AND expires < ?", (key, now))
+            return None
+        if cached_fields is not None:
+            cached_fields = frozenset(cached_fields.split(","))
+        if not covers(cached_fields, fields):
+            return None
+        if now - accessed >= self.touch_interval:
+            self._touch(conn, key, now)
+        return CachedResponse(status, zlib.decompress(body))
+
+    def set(self, key, fields, response, ttl):
+        body = zlib.compress(response.content, self.level)
+        fields = ",".join(sorted(fields)) if fields is not None else None
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            # The first statement takes the write lock, so the total stays exact
+            # with other processes writing to the file.
+            conn.execute("UPDATE meta SET value = value + ? - COALESCE((SELECT size FROM cache WHERE key = ?), 0) "
+                         "WHERE name = 'bytes'", (len(body), key))
+            conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (key, fields, response.status_code, body, len(body), now + ttl, now))
+            self._write_touched(conn, self._take_touched(now))
+            self._evict(conn)
+
+    def _delete(self, conn, where, args):
+        conn.execute("UPDATE meta SET value = value - (SELECT COALESCE(SUM(size), 0) FROM cache WHERE %s) "
+                     "WHERE name = 'bytes'" % where, args)
+        conn.execute("DELETE FROM cache WHERE %s" % where, args)
+
+    def _touch(self, conn, key, now):
+        with self._touch_lock:
+            self._touched[key] = now
+            if len(self._touched) < self.touch_batch and now - self._flushed < self.touch_interval:
+                return
+        touched = self._take_touched(now)
+        with conn:
+            self._write_touched(conn, touched)
+
+    def _take_touched(self, now):
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+            self._flushed = now
+        return touched
+
+    @staticmethod
+    def _write_touched(conn, touched):
+        if touched:
+            conn.executemany("UPDATE cache SET accessed = ? WHERE key = ?",
+                             [(accessed, key) for key, accessed in touched.items()])
+
+    def _total(self, conn):
+        return conn.execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+
+    def _evict(self, conn):
+        total = self._total(conn)
+        if total <= self.max_bytes:
+            return
+        target = total - self.max_bytes * 0.9
+        keys = []
+        freed = 0
+        for key, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            keys.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        conn.executemany("DELETE FROM cache WHERE key = ?", keys)
+        conn.execute("UPDATE meta SET value = value - ? WHERE name = 'bytes'", (freed,))
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM cache")
+            conn.execute("UPDATE meta SET value = 0 WHERE name = 'bytes'")
+        self._take_touched(time.time())
+
+    def stats(self):
+        """Return the hits, misses, number of responses and total compressed size."""
+        conn = self._connect()
+        count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "size": count, "bytes": self._total(conn)}
+
+
+class ChainCache(object):
+    """Several cache backends used as one, e.g. a MemoryCache in front of a SQLiteCache.
+
+    A lookup tries the backends in order, and a response is stored in every
+    backend that accepts its endpoint.
+    """
+
+    def __init__(self, *caches):
+        self.caches = caches
+
+    def lookup(self, method, url, params):
+        for cache in self.caches:
+            response = cache.lookup(method, url, params)
+            if response is not None:
+                return response
+        return None
+
+    def store(self, method, url, params, response):
+        for cache in self.caches:
+            cache.store(method, url, params, response)
+
+    def stats(self):
+        return [cache.stats() for cache in self.caches]
@@ -0,0 +1,285 @@
+# -*- coding:utf-8 -*-
+"""threatbook-enrich: enrich a file of indicators with ThreatBook lookups.
+
+Reads IPs, domains, sha256 hashes and emails from a file or stdin, one per
+line, in a CSV column or in a JSONL key, and writes one JSON line per input
+record, in input order. A failed lookup gives a record whose result holds the
+error in msg, and the errors are logged to stderr. With --checkpoint the number
+of records written and the size of the output after them are saved as the run
+goes, and a restarted run skips them, cuts off anything written after them and
+appends to the output.
+"""
+import argparse
+import csv
+import ipaddress
+import json
+import os
+import re
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from threatbook_api.client import Client
+from threatbook_api.domain_analysis_query import DomainAnalysis
+from threatbook_api.email_analysis_query import Email
+from threatbook_api.file_analysis_query import Report
+from threatbook_api.ioc_query import Ioc
+from threatbook_api.ip_analysis_query import IpAnalysis
+from threatbook_api.ratelimit import RateLimiter, SharedRateLimiter
+from threatbook_api.result import Result
+from threatbook_api.sharding import ShardedRunner
+
+SHA256_RE = re.compile(r"^[0-9a-fA-F]{64}$")
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+DOMAIN_RE = re.compile(r"^(?=.{1,253}$)([a-zA-Z0-9_]([a-zA-Z0-9_-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z][a-zA-Z0-9-]{0,62}\.?$")
+
+
+def classify(indicator):
+    """Return the type of an indicator: "ip", "domain", "hash", "email", or None."""
+    try:
+        ipaddress.ip_address(indicator)
+        return "ip"
+    except ValueError:
+        pass
+    if SHA256_RE.match(indicator):
+        return "hash"
+    if EMAIL_RE.match(indicator):
+        return "email"
+    if DOMAIN_RE.match(indicator):
+        return "domain"
+    return None
+
+
+class Enricher(object):
+    """Route every indicator to the query class of its type.
+
+    The query classes are typed, so every lookup gives a dict, and a failed one
+    a dict whose msg holds the error.
+
+    Attributes:
+        :param api_key: The private API key of the x.threatbook.cn lookups.
+        :param client: The Client shared by all the query classes.
+        :param sandbox_api_key: The API key of the sandbox reports, the default is api_key.
+        :param use_ioc: Whether IPs and domains are checked with Ioc instead of the
+            IP and domain analysis.
+    """
+
+    def __init__(self, api_key, client, sandbox_api_key=None, use_ioc=False):
+        self.ip = IpAnalysis(api_key, client=client, typed=True)
+        self.domain = DomainAnalysis(api_key, client=client, typed=True)
+        self.email = Email(api_key, client=client, typed=True)
+        self.ioc = Ioc(api_key, client=client, typed=True)
+        self.report = Report(sandbox_api_key or api_key, client=client, typed=True)
+        self.use_ioc = use_ioc
+
+    def lookup(self, indicator, kind):
+        if kind in ("ip", "domain") and self.use_ioc:
+            return self.ioc.get_ioc(indicator)
+        if kind == "ip":
+            return self.ip.get_all(indicator)
+        if kind == "domain":
+            return self.domain.get_all(indicator)
+        if kind == "hash":
+            return self.report.get_summary(indicator)
+        if kind == "email":
+            return self.email.get_email(indicator)
+        return None
+
+    def enrich(self, indicator):
+        """Return the output record of an indicator."""
+        kind = classify(indicator)
+        return {"indicator": indicator, "type": kind, "result": self.lookup(indicator, kind)}
+
+
+def make_enricher(api_key, sandbox_api_key, use_ioc, client):
+    """Return the enrich method of an Enricher, the lookup of the worker processes of --processes."""
+    return Enricher(api_key, client, sandbox_api_key, use_ioc).enrich
+
+
+def _indicator(line, key):
+    record = json.loads(line)
+    return str(record.get(key) or "").strip() if isinstance(record, dict) else ""
+
+
+def read_records(stream, fmt, column=None, key="indicator"):
+    """Return an iterator of the indicator of every record of the input, "" for a record without one.
+
+    The CSV header is read at once, a ValueError is raised if it has no column named column.
+    """
+    if fmt == "csv":
+        reader = csv.reader(stream)
+        index = 0
+        if column is not None and not column.isdigit():
+            header = next(reader, [])
+            if column not in header:
+                raise ValueError("no column %r in the CSV header" % column)
+            index = header.index(column)
+        elif column is not None:
+            index = int(column)
+        return (row[index].strip() if len(row) > index else "" for row in reader)
+    if fmt == "jsonl":
+        return (_indicator(line, key) for line in stream if line.strip())
+    return (line for line in (line.strip() for line in stream) if line and not line.startswith("#"))
+
+
+def guess_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        return "csv"
+    if ext in (".jsonl", ".ndjson", ".json"):
+        return "jsonl"
+    return "lines"
+
+
+def read_checkpoint(path):
+    """Return the number of records done and the size of the output after them, None if unknown."""
+    if path and os.path.exists(path):
+        with open(path) as f:
+            state = json.load(f)
+        return state.get("done", 0), state.get("offset")
+    return 0, None
+
+
+def write_checkpoint(path, done, offset=None):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"done": done, "offset": offset}, f)
+    os.replace(tmp, path)
+
+
+def output_offset(output):
+    """Flush the output and return its size in bytes, None when it is not a regular file."""
+    output.flush()
+    return output.tell() if output.seekable() else None
+
+
+def open_output(path, done=0, offset=None):
+    """Open the output file of a run, resumed after done records written up to offset.
+
+    The records written after the last checkpoint, possibly up to the middle of
+    a line, are cut off, since the resumed run writes them again.
+    """
+    if not done:
+        return open(path, "w")
+    if offset is None or not os.path.exists(path):
+        return open(path, "a")
+    output = open(path, "r+")
+    output.seek(offset)
+    output.truncate()
+    return output
+
+
+def enrich_records(enricher, indicators, workers=8):
+    """Enrich the indicators concurrently and yield the records in input order.
+
+    At most twice the number of workers lookups are pending at a time, so the
+    memory used does not grow with the input.
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for indicator in indicators:
+            pending.append(executor.submit(enricher.enrich, indicator))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def sharded_records(runner, indicators):
+    """Enrich the indicators in the worker processes of a ShardedRunner and yield the records in input order."""
+    for indicator, record in runner.run(indicators):
+        if isinstance(record, Result):
+            # The enrich of the worker raised, record is the error.
+            record = {"indicator": indicator, "type": classify(indicator), "result": record}
+        yield record
+
+
+def write_records(records, output, checkpoint=None, checkpoint_every=100, done=0):
+    """Write the records as JSON lines, saving the number written and the output size to the checkpoint.
+
+    :return: Returns the number of records written, including the skipped ones.
+    """
+    for record in records:
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        done += 1
+        if checkpoint and done % checkpoint_every == 0:
+            write_checkpoint(checkpoint, done, output_offset(output))
+    output.flush()
+    if checkpoint:
+        write_checkpoint(checkpoint, done, output_offset(output))
+    return done
+
+
+def enrich_stream(enricher, indicators, output, workers=8, checkpoint=None, checkpoint_every=100, done=0):
+    """Enrich the indicators concurrently and write the records in input order.
+
+    :return: Returns the number of records written, including the skipped ones.
+    """
+    return write_records(enrich_records(enricher, indicators, workers), output, checkpoint, checkpoint_every, done)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="threatbook-enrich", description=__doc__.split("\n")[0])
+    parser.add_argument("input", nargs="?", default="-", help="input file, - for stdin (default)")
+    parser.add_argument("-o", "--output", default="-", help="output JSONL file, - for stdout (default)")
+    parser.add_argument("-f", "--format", choices=("auto", "lines", "csv", "jsonl"), default="auto",
+                        help="input format, guessed from the file extension by default")
+    parser.add_argument("--column", help="CSV column of the indicators, a header name or an index (default 0)")
+    parser.add_argument("--key", default="indicator", help="JSONL key of the indicators (default indicator)")
+    parser.add_argument("--api-key", default=os.environ.get("THREATBOOK_API_KEY"),
+                        help="private API key, the default is $THREATBOOK_API_KEY")
+    parser.add_argument("--sandbox-api-key", default=os.environ.get("THREATBOOK_SANDBOX_API_KEY"),
+                        help="API key of the sandbox reports, the default is the private API key")
+    parser.add_argument("--ioc", action="store_true", help="check IPs and domains with the IOC API")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="number of concurrent lookups (default 8)")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="number of worker processes, each running --workers lookups (default 1)")
+    parser.add_argument("--rate", type=float, help="maximum requests per second")
+    parser.add_argument("--checkpoint", help="file recording the progress, to resume an interrupted run")
+    args = parser.parse_args(argv)
+    if not args.api_key:
+        parser.error("an API key is required, pass --api-key or set THREATBOOK_API_KEY")
+
+    client = None
+    if args.processes > 1:
+        # The worker processes share one rate budget.
+        rate_limiter = SharedRateLimiter(rate=args.rate, rates={}) if args.rate else None
+        runner = ShardedRunner(partial(make_enricher, args.api_key, args.sandbox_api_key, args.ioc),
+                               processes=args.processes, workers=args.workers, rate_limiter=rate_limiter)
+    else:
+        rate_limiter = RateLimiter(rate=args.rate, rates={}) if args.rate else None
+        client = Client(pool_maxsize=args.workers, rate_limiter=rate_limiter)
+        enricher = Enricher(args.api_key, client, args.sandbox_api_key, args.ioc)
+    done, offset = read_checkpoint(args.checkpoint)
+    fmt = guess_format(args.input) if args.format == "auto" else args.format
+
+    stream = sys.stdin if args.input == "-" else open(args.input, newline="" if fmt == "csv" else None)
+    try:
+        indicators = read_records(stream, fmt, args.column, args.key)
+    except ValueError as e:
+        if stream is not sys.stdin:
+            stream.close()
+        parser.error("--column: %s" % e)
+    output = sys.stdout if args.output == "-" else open_output(args.output, done, offset)
+    try:
+        for _ in range(done):
+            if next(indicators, None) is None:
+                break
+        if client is None:
+            records = sharded_records(runner, indicators)
+        else:
+            records = enrich_records(enricher, indicators, args.workers)
+        write_records(records, output, args.checkpoint, done=done)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        if output is not sys.stdout:
+            output.close()
+        if client is not None:
+            client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+# -*- coding:utf-8 -*-
+import copy
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from threatbook_api.instrument import HIT, MISS, RequestEvent, make_hooks
+from threatbook_api.ratelimit import NORMAL
+from threatbook_api.retry import Retry
+from threatbook_api.singleflight import SingleFlight, flight_key
+
+
+class Client(object):
+    """Shared HTTP layer used by all the query classes.
+
+    A client owns one requests session with a keep-alive connection pool per
+    host, so consecutive lookups against x.threatbook.cn and s.threatbook.cn
+    reuse established TCP/TLS connections instead of doing a new handshake
+    for every call. One client can be passed to any number of query objects.
+
+    Attributes:
+        :param pool_connections: The number of per-host connection pools to cache.
+        :param pool_maxsize: The maximum number of connections kept alive per host.
+            Set it to at least the number of threads sharing the client.
+        :param timeout: Default timeout in seconds, either a single number or a
+            (connect, read) tuple. It is used when a call does not pass its own.
+        :param session: An existing requests session to use instead of creating one.
+        :param cache: A cache such as MemoryCache, SQLiteCache or a ChainCache of them.
+            Successful responses are stored in it and identical lookups are
+            answered from it without a request. The cache is shared by all the API
+            keys: a response stored for one key answers the same lookup made with
+            another one. Errors, such as an invalid key, are never cached.
+        :param single_flight: Whether identical requests sent by several threads at
+            the same time with the same API key share one request. Their number is
+            kept in single_flight.shared. The default is True.
+        :param rate_limiter: A RateLimiter that spaces the requests of every API key
+            and counts them against its daily quota.
+        :param priority: The priority of the requests of this client for the daily
+            quota, "normal" or "low". See with_priority.
+        :param retry: The Retry policy of the requests, the default retries connection
+            errors, timeouts and 429 and 5xx responses up to 3 times. Pass
+            Retry(max_attempts=1) to disable retries. Uploads and other requests
+            whose body is not a dict of parameters are never retried.
+        :param base_url: A scheme and host such as "http://127.0.0.1:8080" to which all
+            the requests are sent instead of the ThreatBook hosts, e.g. a MockServer.
+        :param hooks: A Hooks object, such as PrometheusHooks or OpenTelemetryHooks, or a
+            list of them, called around every request with its timings, bytes, cache
+            result and attempts. requests does not tell the DNS and connect times apart,
+            they are part of the server phase, and the download phase also holds the
+            preparation of the request by requests.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, timeout=30, session=None, cache=None,
+                 single_flight=True, rate_limiter=None, priority=NORMAL, retry=None, base_url=None, hooks=None):
+        self.timeout = timeout
+        self.hooks = make_hooks(hooks)
+        self.base_url = base_url
+        self.cache = cache
+        self.single_flight = SingleFlight() if single_flight else None
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+        self.retry = retry if retry is not None else Retry()
+        self.session = session if session is not None else requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the pooled session, or answer it from the cache."""
+        url = rebase(url, self.base_url)
+        kwargs.setdefault("timeout", self.timeout)
+        if self.hooks is None:
+            return self._request(method, url, kwargs, None)
+        event = RequestEvent(method, url, self.hooks)
+        self.hooks.before_request(event)
+        try:
+            response = self._request(method, url, kwargs, event)
+        except Exception as e:
+            event.finish(error=e)
+            self.hooks.after_request(event)
+            raise
+        event.finish(response, body_read=not kwargs.get("stream"))
+        self.hooks.after_request(event)
+        return response
+
+    def _request(self, method, url, kwargs, event):
+        params = kwargs.get("params") or kwargs.get("data")
+        if kwargs.get("files") or not isinstance(params, dict):
+            # File uploads are sent once as they are, their stream can only be read once.
+            return self._attempt(method, url, params, kwargs, event)
+        if kwargs.get("stream"):
+            # A streamed body is read by the caller, it cannot be cached or shared.
+            return self.retry.call(lambda: self._attempt(method, url, params, kwargs, event))
+        if self.cache is not None:
+            response = self.cache.lookup(method, url, params)
+            if event is not None:
+                event.cache = MISS if response is None else HIT
+            if response is not None:
+                return response
+        if self.single_flight is None:
+            return self._send(method, url, params, kwargs, event)
+        key = flight_key(method, url, params)
+        return self.single_flight.do(key, lambda: self._send(method, url, params, kwargs, event))
+
+    def _throttle(self, url, params):
+        if self.rate_limiter is not None:
+            api_key = params.get("apikey") if isinstance(params, dict) else None
+            self.rate_limiter.acquire(api_key, url, self.priority)
+
+    def _attempt(self, method, url, params, kwargs, event=None):
+        if event is None:
+            self._throttle(url, params)
+            return self.session.request(method, url, **kwargs)
+        event.attempts += 1
+        start = time.perf_counter()
+        self._throttle(url, params)
+        sent = time.perf_counter()
+        event.add("throttle", sent - start)
+        response = self.session.request(method, url, **kwargs)
+        # elapsed runs from sending the request to parsing the response headers.
+        server = response.elapsed.total_seconds()
+        event.add("server", server)
+        event.add("download", max(0.0, time.perf_counter() - sent - server))
+        return response
+
+    def _send(self, method, url, params, kwargs, event=None):
+        response = self.retry.call(lambda: self._attempt(method, url, params, kwargs, event))
+        if self.cache is not None:
+            self.cache.store(method, url, params, response)
+        return response
+
+    def get(self, url, params=None, **kwargs):
+        return self.request("GET", url, params=params, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+    def with_priority(self, priority):
+        """Return a client sharing the pool, cache and limits of this one with another priority.
+
+        For example, bulk jobs can use client.with_priority("low") so that they
+        stop before using up the daily quota needed by interactive lookups.
+        """
+        client = copy.copy(self)
+        client.priority = priority
+        return client
+
+    def close(self):
+        """Close all the pooled connections."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def rebase(url, base_url):
+    """Return url with its scheme and host replaced by base_url, or url if base_url is None."""
+    if not base_url:
+        return url
+    parts = urlsplit(url)
+    return base_url.rstrip("/") + url[len(parts.scheme) + 3 + len(parts.netloc):]
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def get_default_client():
+    """Return the process-wide client shared by query objects created without one."""
+    global _default_client
+    if _default_client is None:
+        with _default_lock:
+            if _default_client is None:
+                _default_client = Client()
+    return _default_client
+
+
+def set_default_client(client):
+    """Replace the process-wide client, e.g. to change the pool size or timeouts."""
+    global _default_client
+    with _default_lock:
+        _default_client = client
@@ -0,0 +1,80 @@
+# -*- coding:utf-8 -*-
+"""Decoding of the json response bodies.
+
+The bodies are parsed straight from the bytes received, without decoding them
+to str first. When orjson is installed (``pip install threatbook_api[fast]``)
+it is used by default, otherwise the standard json module is.
+"""
+import json
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The fields kept by a decoder whatever fields are selected.
+STATUS_FIELDS = ("response_code", "msg", "verbose_msg")
+
+
+def select(data, fields):
+    """Return the given top-level fields of a decoded object, with its status fields."""
+    if fields is None or not isinstance(data, dict):
+        return data
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    wanted = set(fields).union(STATUS_FIELDS)
+    return type(data)((key, value) for key, value in data.items() if key in wanted)
+
+
+class JsonDecoder(object):
+    """Decoder using the json module of the standard library."""
+
+    name = "json"
+
+    def loads(self, data, fields=None):
+        """Decode a json body.
+
+        :param data: The body, bytes or str.
+        :param fields: The top-level fields to keep, a comma separated string or a
+            list. The other fields are dropped once parsed. The default keeps all.
+        """
+        return select(json.loads(data), fields)
+
+
+class OrjsonDecoder(object):
+    """Decoder using orjson, several times faster than the json module."""
+
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("OrjsonDecoder requires orjson, install it with pip install orjson")
+
+    def loads(self, data, fields=None):
+        return select(orjson.loads(data), fields)
+
+
+_default_decoder = None
+_default_lock = threading.Lock()
+
+
+def get_decoder():
+    """Return the decoder used for the responses, OrjsonDecoder if orjson is installed."""
+    global _default_decoder
+    if _default_decoder is None:
+        with _default_lock:
+            if _default_decoder is None:
+                _default_decoder = OrjsonDecoder() if orjson is not None else JsonDecoder()
+    return _default_decoder
+
+
+def set_decoder(decoder):
+    """Replace the decoder used for the responses, any object with a loads(data, fields=None) method."""
+    global _default_decoder
+    _default_decoder = decoder
+
+
+def loads(data, fields=None):
+    """Decode a json body with the current decoder."""
+    return get_decoder().loads(data, fields)
@@ -1,7 +1,36 @@
 # -*- coding:utf-8 -*-
-import json
+import threading
 
-import requests
+from threatbook_api.client import get_default_client
+from threatbook_api.endpoints import Endpoint, call, fill
+
+URL = "https://x.threatbook.cn/api/v1/domain/query"
+
+# All the fields of the domain/query API.
+ALL_FIELDS = ["history_whoises", "cur_whois", "history_ips", "cur_ips", "tags", "judgments",
+              "intelligences", "samples", "domains_4_email", "sub_domains"]
+
+
+def _endpoint(fields=None):
+    # The fields missing from a response are returned as "".
+    return Endpoint(URL, "domain", fields=fields, post=[fill(str)])
+
+
+# The endpoint of each query method of DomainAnalysis and AsyncDomainAnalysis.
+ENDPOINTS = {
+    "get_all": _endpoint(",".join(ALL_FIELDS)),
+    "get_history_whoises": _endpoint("history_whoises"),
+    "get_cur_whois": _endpoint("cur_whois"),
+    "get_history_ips": _endpoint("history_ips"),
+    "get_cur_ips": _endpoint("cur_ips"),
+    "get_tags": _endpoint("tags"),
+    "get_judgments": _endpoint("judgments"),
+    "get_intelligences": _endpoint("intelligences"),
+    "get_samples": _endpoint("samples"),
+    "get_domain_4_email": _endpoint("domains_4_email"),
+    "get_sub_domains": _endpoint("sub_domains"),
+    "get_fields": _endpoint(),
+}
 
 
 class DomainAnalysis(object):
@@ -18,13 +47,17 @@ class DomainAnalysis(object):
             the Analysis Platform website. As our business customer or 
             partner, we will deliver your corresponding apikey by mail.
         :param domain:A string domain to be queried.
+        :param client: The Client whose connection pool is used for the requests.
+            The default is the shared client of the process.
+        :param typed: Whether every call returns a Result, a dict that keeps the raw
+            response, errors included, instead of a json string for the errors.
         
     """
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, client=None, typed=False):
         self.api_key = api_key
-        self.msg = ""
-        self.data = {}
+        self.client = client if client is not None else get_default_client()
+        self.typed = typed
         self.response_code = -4
 
     def get_all(self, domain):
@@ -54,29 +87,7 @@ class DomainAnalysis(object):
                 
         :return:Return data in json format.
         """
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": "history_whoises,cur_whois,history_ips,cur_ips,tags,judgments,"
-                               "intelligences,samples,domains_4_email,sub_domains"}
-        # The fields to be queried, separated by commas, with the same field name
-        # as the field name in the output parameter.
-        fields = ["history_whoises", "cur_whois", "history_ips", "cur_ips", "tags", "judgments",
-                  "intelligences", "samples", "domains_4_email", "sub_domains"]
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                for item in fields:
-                    if item not in ret_json:
-                        ret_json[item] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_all"], domain)
 
     def get_history_whoises(self, domain):
         """Get the history_whoises information of the domain.
@@ -88,23 +99,7 @@ class DomainAnalysis(object):
                 registrant_address,registrant_phone,cdate,udate,edate,alexa.
         :return:Return data in json format.
         """
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": "history_whoises"}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if "history_whoises" not in ret_json:
-                    ret_json["history_whoises"] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_history_whoises"], domain)
 
     def get_cur_whois(self, domain):
         """Get the cur_whois information of the domain.
@@ -117,23 +112,7 @@ class DomainAnalysis(object):
                 registrant_address,registrant_phone,cdate,udate,edate,alexa.
         :return: Return data in json format.
         """
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": "cur_whois"}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if "cur_whois" not in ret_json:
-                    ret_json["cur_whois"] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_cur_whois"], domain)
 
     def get_history_ips(self, domain):
         """Get the history_ips information of the domain.
@@ -142,23 +121,7 @@ class DomainAnalysis(object):
                 It is a JSON array, and each item is a JSON object.
         :return:Return data in json format.
         """
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": "history_ips"}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if "history_ips" not in ret_json:
-                    ret_json["history_ips"] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_history_ips"], domain)
 
     def get_cur_ips(self, domain):
         """Get the cur_ips information of the domain.
@@ -167,24 +130,7 @@ class DomainAnalysis(object):
                 It is a JSON array, and each item is a JSON object.
         :return:Return data in json format.
         """
-
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": "cur_ips"}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if "cur_ips" not in ret_json:
-                    ret_json["cur_ips"] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_cur_ips"], domain)
 
     def get_tags(self, domain):
         """Get the tags information of the domain.
@@ -193,23 +139,7 @@ class DomainAnalysis(object):
                 for example: DarkHotel.
         :return:Return data in json format.
         """
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": "tags"}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if "tags" not in ret_json:
-                    ret_json["tags"] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_tags"], domain)
 
     def get_judgments(self, domain):
         """Get the judgments information of the domain.
@@ -218,23 +148,7 @@ class DomainAnalysis(object):
                 remote control, malware, etc., is a JSON array.
         :return: Return data in json format.
         """
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": "judgments"}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if "judgments" not in ret_json:
-                    ret_json["judgments"] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_judgments"], domain)
 
     def get_intelligences(self, domain):
         """Get the intelligences information of the domain.
@@ -242,23 +156,7 @@ class DomainAnalysis(object):
         :field intelligences:Threat Intelligence, is a json array.
         :return: Return data in json format.
         """
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": "intelligences"}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if "intelligences" not in ret_json:
-                    ret_json["intelligences"] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_intelligences"], domain)
 
     def get_samples(self, domain):
         """Get the samples information of the domain.
@@ -266,23 +164,7 @@ class DomainAnalysis(object):
        :field samples:Related sample, is a json array.
        :return: Return data in json format.
        """
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": "samples"}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if "samples" not in ret_json:
-                    ret_json["samples"] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_samples"], domain)
 
     def get_domain_4_email(self, domain):
         """Get the domains_4_email information of the domain.
@@ -291,23 +173,7 @@ class DomainAnalysis(object):
                 another domain name, is an array.
         :return: Return data in json format.
        """
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": "domains_4_email"}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if "domains_4_email" not in ret_json:
-                    ret_json["domains_4_email"] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_domain_4_email"], domain)
 
     def get_sub_domains(self, domain):
         """Get the sub_domains information of the domain.
@@ -316,24 +182,7 @@ class DomainAnalysis(object):
                 is an array.
         :return: Return data in json format.
        """
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": "sub_domains"}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if "sub_domains" not in ret_json:
-                    ret_json["sub_domains"] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
-
+        return call(self, ENDPOINTS["get_sub_domains"], domain)
 
     def get_fields(self,domain,fields):
         """Get information about the specified field.
@@ -362,24 +211,110 @@ class DomainAnalysis(object):
                 sub_domains: The subdomain under the second-level domain corresponding to the domain,
                         is an array.
         """
-        url = "https://x.threatbook.cn/api/v1/domain/query"
-        parameters = {"domain": domain, "apikey": self.api_key,
-                      "field": fields}
-        field_list = fields.split(',')
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                for item in field_list:
-                    if item not in ret_json:
-                        ret_json[item] = ""
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_fields"], domain, fields)
+
+    def lookup(self, domain, fields=None):
+        """Get a lazy result of the domain that queries all the wanted fields at once.
+
+        :param domain: A string domain to be queried.
+        :param fields: The fields to be queried, a comma separated string or a list.
+            More fields can be added later with DomainLookup.want.
+        :return: Return a DomainLookup object.
+        """
+        return DomainLookup(self, domain, fields)
+
+
+class DomainLookup(object):
+    """Lazy result of a domain that coalesces field queries into one request.
+
+    The fields passed in or added with want() are collected and sent together in
+    a single domain/query call the first time a getter needs data. The merged
+    response is kept, so later getters whose fields were already fetched are
+    answered without another request. A getter for a field that was not fetched
+    yet sends one request for it and for all other pending fields.
+
+    Attributes:
+        :param analysis: The DomainAnalysis object used to send the query.
+        :param domain: A string domain to be queried.
+        :param fields: The fields to be queried, a comma separated string or a list.
+    """
+
+    def __init__(self, analysis, domain, fields=None):
+        self.analysis = analysis
+        self.domain = domain
+        self.response = None
+        self._fetched = set()
+        self._pending = []
+        self._lock = threading.Lock()
+        if fields:
+            self.want(fields)
+
+    def want(self, fields):
+        """Add fields to the next query without sending it.
+
+        :param fields: A comma separated string or a list of field names.
+        :return: Return the DomainLookup itself.
+        """
+        if isinstance(fields, str):
+            fields = fields.split(",")
+        with self._lock:
+            for item in fields:
+                item = item.strip()
+                if item and item not in self._fetched and item not in self._pending:
+                    self._pending.append(item)
+        return self
+
+    def get_fields(self, fields):
+        """Get the specified fields, querying the missing and pending ones in one request.
+
+        :param fields: A comma separated string or a list of field names.
+        :return: Return the merged response of all the fields fetched so far,
+            or the error result of the query if it failed.
+        """
+        self.want(fields)
+        with self._lock:
+            if self._pending:
+                ret_json = self.analysis.get_fields(self.domain, ",".join(self._pending))
+                if not isinstance(ret_json, dict) or ret_json.get("response_code") != 0:
+                    return ret_json
+                if self.response is None:
+                    self.response = ret_json
+                else:
+                    self.response.update(ret_json)
+                self._fetched.update(self._pending)
+                self._pending = []
+            return self.response
+
+    def get_all(self):
+        return self.get_fields(ALL_FIELDS)
+
+    def get_history_whoises(self):
+        return self.get_fields("history_whoises")
+
+    def get_cur_whois(self):
+        return self.get_fields("cur_whois")
+
+    def get_history_ips(self):
+        return self.get_fields("history_ips")
+
+    def get_cur_ips(self):
+        return self.get_fields("cur_ips")
+
+    def get_tags(self):
+        return self.get_fields("tags")
+
+    def get_judgments(self):
+        return self.get_fields("judgments")
+
+    def get_intelligences(self):
+        return self.get_fields("intelligences")
+
+    def get_samples(self):
+        return self.get_fields("samples")
+
+    def get_domain_4_email(self):
+        return self.get_fields("domains_4_email")
 
+    def get_sub_domains(self):
+        return self.get_fields("sub_domains")
 
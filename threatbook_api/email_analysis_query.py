@@ -1,6 +1,9 @@
 # -*- coding:utf-8 -*-
-import json
-import requests
+
+from threatbook_api.client import get_default_client
+from threatbook_api.endpoints import Endpoint, call
+
+ENDPOINT = Endpoint("https://x.threatbook.cn/api/v1/domain4email/query", "email")
 
 
 class Email(object):
@@ -11,12 +14,16 @@ class Email(object):
             It is different from the Public API apikey registered through 
             the Analysis Platform website. As our business customer or 
             partner, we will deliver your corresponding apikey by mail.
+        :param client: The Client whose connection pool is used for the requests.
+            The default is the shared client of the process.
+        :param typed: Whether every call returns a Result, a dict that keeps the raw
+            response, errors included, instead of a json string for the errors.
     """
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, client=None, typed=False):
         self.api_key = api_key
-        self.msg = ""
-        self.data = {}
+        self.client = client if client is not None else get_default_client()
+        self.typed = typed
         self.response_code = -4
 
     def get_email(self, email):
@@ -25,19 +32,4 @@ class Email(object):
         :return: Returns a json object containing the total number 
             of domain and each domain name.
         """
-        url = "https://x.threatbook.cn/api/v1/domain4email/query"
-        parameters = {"apikey": self.api_key, "email": email}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
-
+        return call(self, ENDPOINT, email)
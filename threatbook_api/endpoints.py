@@ -0,0 +1,116 @@
+# -*- coding:utf-8 -*-
+"""Declarative description of the calls of the ThreatBook API.
+
+Every query method is described by an Endpoint: the URL, the HTTP method, the
+parameter holding the indicator, the fields asked for and the post-processors
+applied to a successful response. call and call_async are the only code that
+sends a query and turns its response into a result, for the blocking and the
+async query classes, whose public methods are one-line wrappers of them.
+A request that raises is logged as a warning of the threatbook_api logger,
+with the API key redacted from the message.
+"""
+import logging
+
+from threatbook_api.result import decode, encode, failure, redact
+
+logger = logging.getLogger("threatbook_api")
+
+
+class Endpoint(object):
+    """One call of the API.
+
+    Attributes:
+        :param url: The URL of the API.
+        :param key: The name of the parameter holding the indicator, such as "ip".
+        :param method: The HTTP method, "POST" or "GET".
+        :param fields: The fields asked for, a comma separated string. None when the
+            API takes no field parameter or when the caller passes the fields.
+        :param params: The names of the attributes of the query object sent as
+            parameters too, such as ("sandbox_type",).
+        :param post: The post-processors of a successful response, called in turn as
+            post(query, ret_json, value, fields) with the indicator and the list of
+            the fields asked for. Each one returns the result.
+    """
+
+    __slots__ = ("url", "key", "method", "fields", "params", "post", "_fields_list", "_payload")
+
+    def __init__(self, url, key, method="POST", fields=None, params=(), post=()):
+        self.url = url
+        self.key = key
+        self.method = method
+        self.fields = fields
+        self.params = tuple(params)
+        self.post = tuple(post)
+        self._fields_list = fields.split(",") if fields else []
+        self._payload = "params" if method == "GET" else "data"
+
+    def parameters(self, query, value, fields=None):
+        """Return the parameters of the request of query for an indicator."""
+        parameters = {"apikey": query.api_key}
+        for name in self.params:
+            parameters[name] = getattr(query, name)
+        parameters[self.key] = value
+        fields = fields if fields is not None else self.fields
+        if fields is not None:
+            parameters["field"] = fields
+        return parameters
+
+    def finish(self, query, response, value, fields=None):
+        """Return the result of a response: the post-processed json on success, else the error result."""
+        if response.status_code == 200:
+            ret_json = decode(response, query.typed)
+            if self.post:
+                fields_list = self._fields_list if fields is None else fields.split(",")
+                for post in self.post:
+                    ret_json = post(query, ret_json, value, fields_list)
+            return ret_json
+        res = {"data": {}, "msg": (response.status_code, "not fount"), "response_code": query.response_code}
+        return encode(res, query.typed, response.status_code)
+
+
+def call(query, endpoint, value, fields=None):
+    """Send the request of an endpoint with the client of a query object and return the result.
+
+    :param query: The query object, with api_key, client, typed and the
+        response_code of the error results. It is only read, so one query
+        object can be used by any number of threads or tasks at the same time.
+    :param value: The indicator.
+    :param fields: The fields asked for, for an endpoint without fields of its own.
+    """
+    kwargs = {endpoint._payload: endpoint.parameters(query, value, fields)}
+    try:
+        response = query.client.request(endpoint.method, endpoint.url, **kwargs)
+    except Exception as e:
+        return failed(endpoint, e, query.typed)
+    return endpoint.finish(query, response, value, fields)
+
+
+async def call_async(query, endpoint, value, fields=None):
+    """Coroutine of call, for the async query objects."""
+    kwargs = {endpoint._payload: endpoint.parameters(query, value, fields)}
+    try:
+        response = await query.client.request(endpoint.method, endpoint.url, **kwargs)
+    except Exception as e:
+        return failed(endpoint, e, query.typed)
+    return endpoint.finish(query, response, value, fields)
+
+
+def failed(endpoint, error, typed=False):
+    """Log a request of an endpoint that raised error and return its error result."""
+    logger.warning("%s %s failed: %s", endpoint.method, endpoint.url, redact(str(error)))
+    return failure(error, typed)
+
+
+def fill(empty, success_only=False):
+    """Return a post-processor adding the fields missing from a response.
+
+    :param empty: The type of the value of a missing field, str for "" or dict for {}.
+    :param success_only: Whether only the responses with response_code 0 are filled.
+    """
+    def post(query, ret_json, value, fields):
+        if not success_only or ret_json.get("response_code") == 0:
+            for item in fields:
+                if item not in ret_json:
+                    ret_json[item] = empty()
+        return ret_json
+    return post
@@ -0,0 +1,12 @@
+# -*- coding:utf-8 -*-
+from threatbook_api.domain_analysis_query import DomainAnalysis
+
+# If you need several fields of one domain, the lookup method collects them and queries them in one request.
+
+# create an instance object
+test = DomainAnalysis('your private api_key')
+
+# Both fields are fetched by the first getter, the second getter is served from the same response
+domain = test.lookup('domain to be queried ', 'cur_whois,tags')
+print(domain.get_cur_whois())
+print(domain.get_tags())
@@ -1,14 +1,83 @@
 # -*- coding:utf-8 -*-
-import json
-import requests
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from requests import RequestException
+
+from threatbook_api.client import get_default_client
+from threatbook_api.endpoints import Endpoint, call, failed
+from threatbook_api.hashindex import is_sha256
+from threatbook_api.multipart import CHUNK_SIZE, MultipartStream, hash_file
+from threatbook_api.result import encode, redact
+from threatbook_api.streaming import ItemParser, StreamError
+
+REPORT_URL = "https://s.threatbook.cn/api/v2/file/report"
+
+
+def record_hash(query, ret_json, sha256, fields):
+    """Post-processor adding the sha256 of a report found to the known_hashes of the query.
+
+    A value that is not a sha256, such as an md5 passed by the caller, is not recorded.
+    """
+    if query.known_hashes is not None and ret_json.get("response_code") == 0 and is_sha256(sha256):
+        query.known_hashes.add(sha256)
+    return ret_json
+
+
+def no_data(query, ret_json, resource, fields):
+    """Post-processor of fetch_file_legal_ca, whose response_code 0 means that the file has no certificate."""
+    if ret_json["response_code"] == 0:
+        ret_json["msg"] = "no data"
+    return ret_json
+
+
+def _section(section, post=()):
+    url = REPORT_URL + "/" + section if section else REPORT_URL
+    return Endpoint(url, "sha256", "GET", params=["sandbox_type"], post=post)
+
+
+# The endpoint of each query method of Report and AsyncReport.
+ENDPOINTS = {
+    "get_report": _section("", [record_hash]),
+    "get_summary": _section("summary", [record_hash]),
+    "get_ioc": _section("ioc"),
+    "get_system": _section("system"),
+    "get_network": _section("network"),
+    "get_signature": _section("signature"),
+    "get_static": _section("static"),
+    "get_dropped": _section("dropped"),
+    "get_pstree": _section("pstree"),
+    "get_multiengines": _section("multiengines"),
+}
+
+# The multipart upload, sent by Upload and AsyncUpload, whose indicator is the sha256 of the file sent.
+UPLOAD_ENDPOINT = Endpoint("https://s.threatbook.cn/api/v2/file/upload", "file", post=[record_hash])
+
+FETCH_FILE_ENDPOINT = Endpoint("https://x.threatbook.cn/api/v1/file/fetch_file_legal_ca", "resource", post=[no_data])
+
+
+def merge_sections(results, typed=False):
+    """Return the result of get_fields from the results of its sections, in order.
+
+    If a section failed, its own error result is returned instead, since the
+    data of the other sections alone would pass for a complete report.
+    """
+    data_list = []
+    for res in results:
+        if not isinstance(res, dict) or res.get("response_code") != 0:
+            return res
+        data_list.append(res.get("data", {}))
+    res = {"data": data_list, "msg": "", "response_code": 0}
+    return encode(res, typed)
 
 
 class Upload(object):
     """Upload the file for analysis.
     """
 
-    def __init__(self, api_key, sandbox_type="win7_sp1_enx86_office2013", run_time=60, file_path=os.path.abspath(".")):
+    def __init__(self, api_key, sandbox_type="win7_sp1_enx86_office2013", run_time=60, file_path=os.path.abspath("."),
+                 client=None, known_hashes=None, typed=False):
         """
         :param api_key: You will need to register for a threatbook account 
             and view your API Key through the Personal Center. This Key will 
@@ -24,32 +93,77 @@ class Upload(object):
         :param run_time: Sandbox running time, default 60s, controlled within
             300s according to demand.
         :param file_path: The path where you uploaded the file.The default is the current path.
+        :param client: The Client whose connection pool is used for the requests.
+            The default is the shared client of the process.
+        :param typed: Whether every call returns a Result, a dict that keeps the raw
+            response, errors included, instead of a json string for the errors.
+        :param known_hashes: A HashIndex of the samples already analyzed. A file whose
+            sha256 is in it is not uploaded, and uploaded files are added to it.
         """
 
         self.api_key = api_key
         self.sandbox_type = sandbox_type
         self.run_time = run_time
         self.path = file_path
+        self.client = client if client is not None else get_default_client()
+        self.typed = typed
+        self.known_hashes = known_hashes
+        self.response_code = -4
 
-    def upload_file(self, file, ):
+    def upload_file(self, file, filename=None, skip_analyzed=False):
         """
         :param file: Files that need to be analyzed, the single file size 
-        is controlled within 20MB.
+        is controlled within 20MB. It is a file name under the file path,
+        a binary file object or bytes. The file is streamed in chunks and
+        a file opened here is closed before returning.
+        :param filename: The file name sent with the file, the default is the
+            file name, or the name of the file object.
+        :param skip_analyzed: Whether to compute the sha256 first and skip the
+            upload when the sandbox already has a report of the file. The
+            file object must then be seekable.
         :return: Returns the sha256 of the file and the URL of the report.
+            A skipped upload returns the sha256 with the message "already analyzed".
+            With known_hashes, the sha256 of a seekable file is computed first and
+            a known file is skipped without any request.
         """
-        url = "https://s.threatbook.cn/api/v2/file/upload"
+        if isinstance(file, (bytes, bytearray)):
+            return self._upload(io.BytesIO(file), filename or "sample", skip_analyzed)
+        if hasattr(file, "read"):
+            name = getattr(file, "name", None)
+            if not isinstance(name, str):
+                name = "sample"
+            return self._upload(file, filename or os.path.basename(name), skip_analyzed)
+        with open(os.path.join(self.path, file), "rb") as f:
+            return self._upload(f, filename or file, skip_analyzed)
+
+    def _upload(self, fileobj, filename, skip_analyzed):
+        sha256 = None
+        if skip_analyzed or (self.known_hashes is not None and getattr(fileobj, "seekable", lambda: False)()):
+            sha256 = hash_file(fileobj)
+        if sha256 is not None and self.known_hashes is not None and sha256 in self.known_hashes:
+            return self._analyzed(sha256)
+        if skip_analyzed:
+            report = Report(self.api_key, self.sandbox_type, self.run_time, client=self.client,
+                            known_hashes=self.known_hashes)
+            summary = report.get_summary(sha256)
+            if isinstance(summary, dict) and summary.get("response_code") == 0:
+                return self._analyzed(sha256)
         fields = {
             "apikey": self.api_key,
             "sandbox_type": self.sandbox_type,
             "run_time": self.run_time
         }
-        dir = self.path
-        file_name = file
-        files = {
-            "file": (file_name, open(os.path.join(dir, file_name), "rb"))
-        }
-        response = requests.post(url, data=fields, files=files)
-        return response.json()
+        body = MultipartStream(fields, "file", filename, fileobj)
+        try:
+            response = self.client.post(UPLOAD_ENDPOINT.url, data=body, headers={"Content-Type": body.content_type})
+        except Exception as e:
+            return failed(UPLOAD_ENDPOINT, e, self.typed)
+        # The whole file was read while it was sent, body.sha256 is complete.
+        return UPLOAD_ENDPOINT.finish(self, response, body.sha256)
+
+    def _analyzed(self, sha256):
+        res = {"data": {"sha256": sha256}, "msg": "already analyzed", "response_code": 0}
+        return encode(res, self.typed, 200) if self.typed else res
 
 
 class Report(object):
@@ -69,245 +183,114 @@ class Report(object):
         :param run_time: Sandbox running time, default 60s, controlled within
             300s according to demand.
         :param sha256:The sha256 value of the file.
+        :param client: The Client whose connection pool is used for the requests.
+            The default is the shared client of the process.
+        :param typed: Whether every call returns a Result, a dict that keeps the raw
+            response, errors included, instead of a json string for the errors.
+        :param max_workers: The maximum number of report sections fetched at the
+            same time by get_fields, the default is 4.
+        :param known_hashes: A HashIndex to which the sha256 of every report found
+            by get_report or get_summary is added.
     """
 
-    def __init__(self, api_key, sandbox_type="win7_sp1_enx86_office2013", run_time=60):
+    def __init__(self, api_key, sandbox_type="win7_sp1_enx86_office2013", run_time=60, client=None, max_workers=4,
+                 known_hashes=None, typed=False):
         self.api_key = api_key
+        self.client = client if client is not None else get_default_client()
+        self.typed = typed
         self.sandbox_type = sandbox_type
         self.run_time = run_time
-        self.msg = ""
-        self.data = {}
+        self.max_workers = max_workers
+        self.known_hashes = known_hashes
         self.response_code = -4
 
     def get_report(self, sha256):
         """Get a full report of the file."""
-        url = "https://s.threatbook.cn/api/v2/file/report"
-        params = {
-            "apikey": self.api_key,
-            "sandbox_type": self.sandbox_type,
-            "sha256": sha256
-        }
-        try:
-            response = requests.get(url, params=params)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_report"], sha256)
 
     def get_summary(self, sha256):
         """Get the summary information of the report"""
-        url = "https://s.threatbook.cn/api/v2/file/report/summary"
-        params = {
-            "apikey": self.api_key,
-            "sandbox_type": self.sandbox_type,
-            "sha256": sha256
-        }
-        try:
-            response = requests.get(url, params=params)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_summary"], sha256)
 
     def get_ioc(self, sha256):
         """Get threat information for documents IOC report."""
-        url = "https://s.threatbook.cn/api/v2/file/report/ioc"
-        params = {
-            "apikey": self.api_key,
-            "sandbox_type": self.sandbox_type,
-            "sha256": sha256
-        }
-        try:
-            response = requests.get(url, params=params)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_ioc"], sha256)
 
     def get_system(self, sha256):
         """Get an intelligence system test report for the file."""
-        url = "https://s.threatbook.cn/api/v2/file/report/system"
-        params = {
-            "apikey": self.api_key,
-            "sandbox_type": self.sandbox_type,
-            "sha256": sha256
-        }
-        try:
-            response = requests.get(url, params=params)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_system"], sha256)
 
     def get_network(self, sha256):
         """Get a web behavior report for the file."""
-        url = "https://s.threatbook.cn/api/v2/file/report/network"
-        params = {
-            "apikey": self.api_key,
-            "sandbox_type": self.sandbox_type,
-            "sha256": sha256
-        }
-        try:
-            response = requests.get(url, params=params)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_network"], sha256)
 
     def get_signature(self, sha256):
         """Get the behavior signature report of the file."""
-        url = "https://s.threatbook.cn/api/v2/file/report/signature"
-        params = {
-            "apikey": self.api_key,
-            "sandbox_type": self.sandbox_type,
-            "sha256": sha256
-        }
-        try:
-            response = requests.get(url, params=params)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_signature"], sha256)
 
     def get_static(self, sha256):
         """Get a static report of the file."""
-        url = "https://s.threatbook.cn/api/v2/file/report/static"
-        params = {
-            "apikey": self.api_key,
-            "sandbox_type": self.sandbox_type,
-            "sha256": sha256
-        }
-        try:
-            response = requests.get(url, params=params)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_static"], sha256)
 
     def get_dropped(self, sha256):
         """Get the release file report for the file."""
-        url = "https://s.threatbook.cn/api/v2/file/report/dropped"
-        params = {
-            "apikey": self.api_key,
-            "sandbox_type": self.sandbox_type,
-            "sha256": sha256
-        }
-        try:
-            response = requests.get(url, params=params)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_dropped"], sha256)
 
     def get_pstree(self, sha256):
         """Get the process tree report for the file."""
-        url = "https://s.threatbook.cn/api/v2/file/report/pstree"
-        params = {
-            "apikey": self.api_key,
-            "sandbox_type": self.sandbox_type,
-            "sha256": sha256
-        }
-        try:
-            response = requests.get(url, params=params)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_pstree"], sha256)
 
     def get_multiengines(self, sha256):
         """Get a multi-engine detection report for the file."""
-        url = "https://s.threatbook.cn/api/v2/file/report/multiengines"
-        params = {
-            "apikey": self.api_key,
-            "sandbox_type": self.sandbox_type,
-            "sha256": sha256
-        }
-        try:
-            response = requests.get(url, params=params)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_multiengines"], sha256)
 
+    def iter_section(self, sha256, section, path=None, chunk_size=CHUNK_SIZE):
+        """
+        Yield the items of an array of a report section while it is downloaded.
+        Only one item is held in memory at a time, and the first items can be
+        processed before the end of the response is received.
+        :param section: The report section, such as "network", "dropped" or "system",
+            or "" for the full report.
+        :param path: The keys leading to the array in the response, a dotted string
+            such as "data.network.tcp". The default is "data." followed by the section.
+            The members of an object are yielded as (key, value) tuples.
+        :param chunk_size: The number of bytes read from the response at a time.
+        :return: Yields the items. Raises StreamError when the request fails, the
+            connection included, or the report is not available.
+        """
+        endpoint = ENDPOINTS.get("get_" + section if section else "get_report") or _section(section)
+        parser = ItemParser(path if path is not None else ".".join(filter(None, ["data", section])))
+        try:
+            response = self.client.get(endpoint.url, params=endpoint.parameters(self, sha256), stream=True)
+        except RequestException as e:
+            raise StreamError(redact(str(e)), self.response_code) from e
+        try:
+            if response.status_code != 200:
+                raise StreamError((response.status_code, "not fount"), self.response_code)
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    for item in parser.feed(chunk):
+                        yield item
+            except RequestException as e:
+                raise StreamError(redact(str(e)), self.response_code) from e
+        finally:
+            response.close()
+        response_code = parser.status.get("response_code")
+        if response_code not in (None, 0) or not parser.found:
+            raise StreamError(parser.status.get("msg", "%s not found" % ".".join(parser.path)), response_code)
+        for post in endpoint.post:
+            post(self, parser.status, sha256, [])
 
     def get_fields(self,sha256,fields):
         """
         Get the data of the corresponding field according to the sha256 of the file.
         :param fields: The field name of the data to be returned, the string format. 
             If there are multiple fields, the fields are separated by commas.
+        The sections are fetched concurrently by up to max_workers threads and
+        their data is returned in the order of the fields. If a section fails,
+        its error is returned instead.
         :return: Returns data in json format that satisfies the submission.
         """
-        data_list = []
         func_dict = {
             'summary':self.get_report,
             'ioc':self.get_ioc,
@@ -319,14 +302,12 @@ class Report(object):
             'pstree':self.get_pstree,
             'multiengines':self.get_multiengines
         }
-        field_list = fields.split(',')
-        for field in field_list:
-            if field in func_dict:
-                res = func_dict[field](sha256)
-                data_list.append(res.get('data',{}))
-
-        res = {"data": data_list, "msg": self.msg, "response_code":0}
-        return json.dumps(res)
+        funcs = [func_dict[field] for field in fields.split(',') if field in func_dict]
+        results = []
+        if funcs:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(funcs))) as executor:
+                results = list(executor.map(lambda func: func(sha256), funcs))
+        return merge_sections(results, self.typed)
 
 
 class FetchFile(object):
@@ -337,12 +318,16 @@ class FetchFile(object):
             It is different from the Public API apikey registered through
             the Analysis Platform website. As our business customer or
             partner, we will deliver your corresponding apikey by mail.
+        :param client: The Client whose connection pool is used for the requests.
+            The default is the shared client of the process.
+        :param typed: Whether every call returns a Result, a dict that keeps the raw
+            response, errors included, instead of a json string for the errors.
     """
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, client=None, typed=False):
         self.api_key = api_key
-        self.msg = ""
-        self.data = {}
+        self.client = client if client is not None else get_default_client()
+        self.typed = typed
         self.response_code = -4
 
     def get_all(self, resource):
@@ -352,24 +337,7 @@ class FetchFile(object):
         :return: Returns a json object containing the signature organization
             name and certificate chain information.
         """
-
-        url = "https://x.threatbook.cn/api/v1/file/fetch_file_legal_ca"
-        parameter = {"apikey": self.api_key, "resource": resource}
-        try:
-            response = requests.post(url, parameter)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if ret_json["response_code"] == 0:
-                    ret_json["msg"] = "no data"
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, FETCH_FILE_ENDPOINT, resource)
 
     def get_legallssuer(self, resource):
         """
@@ -382,7 +350,7 @@ class FetchFile(object):
         data0 = self.get_all(resource)
         if data0["response_code"] == 1:
             data1 = data0.get("LegalIssuer", {})
-            res = {"LegalIssuer": data1, "msg": self.msg, "response_code": 0}
+            res = {"LegalIssuer": data1, "msg": "", "response_code": 0}
             return res
         else:
             return data0
@@ -396,7 +364,7 @@ class FetchFile(object):
         data0 = self.get_all(resource)
         if data0["response_code"] == 1:
             data1 = data0.get("cas", {})
-            res = {"cas": data1, "msg": self.msg, "response_code": 0}
+            res = {"cas": data1, "msg": "", "response_code": 0}
             return res
         else:
             return data0
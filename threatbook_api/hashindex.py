@@ -0,0 +1,166 @@
+# -*- coding:utf-8 -*-
+import binascii
+import mmap
+import os
+import threading
+
+DIGEST_SIZE = 32
+
+
+def is_sha256(value):
+    """Whether value is a sha256 as HashIndex takes it: 64 hex characters or 32 raw bytes."""
+    try:
+        HashIndex._digest(value)
+    except ValueError:
+        return False
+    return True
+
+
+class HashIndex(object):
+    """Set of sha256 hashes kept on disk as a sorted array of raw digests.
+
+    The index file holds the 32-byte digests in sorted order and is memory
+    mapped, so a lookup is a binary search that only touches a few pages and
+    the index costs 32 bytes of disk per hash and almost no memory, even with
+    tens of millions of hashes. New hashes are appended to a journal file and
+    kept in a small in-memory set until they are merged into the sorted array,
+    which happens when merge_every hashes are pending or when merge is called.
+
+    An index is meant to have one writing process at a time; any number of
+    processes may read it.
+
+    Attributes:
+        :param path: The path of the index file. The journal is path + ".log".
+        :param merge_every: The number of pending hashes that triggers a merge.
+    """
+
+    def __init__(self, path, merge_every=100000):
+        self.path = os.path.abspath(path)
+        self.log_path = self.path + ".log"
+        self.merge_every = merge_every
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._file = None
+        self._map = None
+        self._count = 0
+        self._open()
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "rb") as f:
+                data = f.read()
+            usable = len(data) - len(data) % DIGEST_SIZE
+            # A process that died between the replace and the truncation of a
+            # merge left a journal whose digests are already in the array.
+            for i in range(0, usable, DIGEST_SIZE):
+                digest = data[i:i + DIGEST_SIZE]
+                if not self._search(digest):
+                    self._pending.add(digest)
+        self._log = open(self.log_path, "ab")
+
+    def _open(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self._map = None
+        self._file = None
+        self._count = 0
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= DIGEST_SIZE:
+            self._file = open(self.path, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._count = len(self._map) // DIGEST_SIZE
+
+    @staticmethod
+    def _digest(sha256):
+        # Anything else, such as an md5, would break the fixed size records of the array.
+        if isinstance(sha256, (bytes, bytearray)) and len(sha256) == DIGEST_SIZE:
+            return bytes(sha256)
+        if isinstance(sha256, (str, bytes, bytearray)) and len(sha256.strip()) == DIGEST_SIZE * 2:
+            return binascii.unhexlify(sha256.strip())
+        raise ValueError("not a sha256: %r" % (sha256,))
+
+    def _position(self, digest):
+        # Index of the first digest of the sorted array not lower than digest.
+        lo, hi = 0, self._count
+        mm = self._map
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = mid * DIGEST_SIZE
+            if mm[offset:offset + DIGEST_SIZE] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _search(self, digest):
+        position = self._position(digest)
+        offset = position * DIGEST_SIZE
+        return position < self._count and self._map[offset:offset + DIGEST_SIZE] == digest
+
+    def __contains__(self, sha256):
+        try:
+            digest = self._digest(sha256)
+        except (binascii.Error, TypeError, ValueError):
+            return False
+        with self._lock:
+            return digest in self._pending or self._search(digest)
+
+    def __len__(self):
+        return self._count + len(self._pending)
+
+    def add(self, sha256):
+        """Add a sha256, given as 64 hex characters or 32 raw bytes, else raise ValueError."""
+        digest = self._digest(sha256)
+        with self._lock:
+            if digest in self._pending or self._search(digest):
+                return
+            self._pending.add(digest)
+            self._log.write(digest)
+            self._log.flush()
+            if len(self._pending) >= self.merge_every:
+                self._merge()
+
+    def add_many(self, hashes):
+        for sha256 in hashes:
+            self.add(sha256)
+
+    def merge(self):
+        """Merge the pending hashes into the sorted index file."""
+        with self._lock:
+            self._merge()
+
+    def _merge(self):
+        if not self._pending:
+            return
+        tmp = self.path + ".tmp"
+        pending = sorted(self._pending)
+        with open(tmp, "wb") as out:
+            # Copy the runs of the sorted array between the insertion points of
+            # the pending hashes, which are not in the array.
+            start = 0
+            for digest in pending:
+                position = self._position(digest)
+                if position > start:
+                    out.write(self._map[start * DIGEST_SIZE:position * DIGEST_SIZE])
+                out.write(digest)
+                start = position
+            if self._count > start:
+                out.write(self._map[start * DIGEST_SIZE:self._count * DIGEST_SIZE])
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, self.path)
+        self._open()
+        self._pending.clear()
+        self._log.close()
+        self._log = open(self.log_path, "wb")
+
+    def reload(self):
+        """Map the index file again, to see the hashes merged by another process."""
+        with self._lock:
+            self._open()
+
+    def close(self):
+        with self._lock:
+            self._log.close()
+            if self._map is not None:
+                self._map.close()
+                self._file.close()
+                self._map = None
@@ -0,0 +1,259 @@
+# -*- coding:utf-8 -*-
+"""Instrumentation hooks of the requests sent by Client and AsyncClient.
+
+A client created with hooks calls them around every request with a
+RequestEvent holding the timings of the phases of the request, the bytes
+transferred, the cache result and the number of attempts. Without hooks the
+clients skip all of it. PrometheusHooks and OpenTelemetryHooks export the
+events, they need prometheus_client and opentelemetry-api respectively
+(``pip install threatbook_api[prometheus]`` or ``threatbook_api[otel]``).
+"""
+import contextvars
+import time
+from urllib.parse import urlsplit
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+# The event of the last request sent from the current thread or task, whose
+# decoding is timed by result.decode.
+_current = contextvars.ContextVar("threatbook_request_event", default=None)
+
+HIT = "hit"
+MISS = "miss"
+
+
+class RequestEvent(object):
+    """What happened to one request.
+
+    Attributes:
+        :param method: The HTTP method.
+        :param url: The URL of the request.
+        :param endpoint: The path of the URL, such as /api/v1/ip/query.
+        :param started: The time.time() at which the request started.
+        :param timings: The seconds spent in each phase. Any of: throttle (waiting for
+            the rate limiter), dns, connect (TCP and TLS), server (from the request
+            sent to the response headers), download, decode, and total.
+        :param bytes_sent: The size of the request body, None if unknown.
+        :param bytes_received: The size of the response body, None if unknown.
+        :param status_code: The HTTP status of the response, None if none was received.
+        :param cache: "hit" or "miss" when the client has a cache, else None.
+        :param attempts: The number of times the request was sent, 0 when the
+            response came from the cache or from an identical request in flight.
+        :param error: The exception raised by the request, if any.
+        :param context: A dict where hooks can keep their own state of the request.
+    """
+
+    __slots__ = ("method", "url", "endpoint", "started", "timings", "bytes_sent", "bytes_received",
+                 "status_code", "cache", "attempts", "error", "context", "response", "hooks", "_clock")
+
+    def __init__(self, method, url, hooks):
+        self.method = method
+        self.url = url
+        self.endpoint = urlsplit(url).path
+        self.started = time.time()
+        self.timings = {}
+        self.bytes_sent = None
+        self.bytes_received = None
+        self.status_code = None
+        self.cache = None
+        self.attempts = 0
+        self.error = None
+        self.context = {}
+        self.response = None
+        self.hooks = hooks
+        self._clock = time.perf_counter()
+
+    @property
+    def retries(self):
+        return max(0, self.attempts - 1)
+
+    def add(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def finish(self, response=None, error=None, body_read=True):
+        """Record the end of the request and make it the current event."""
+        self.timings["total"] = time.perf_counter() - self._clock
+        self.error = error
+        if response is not None:
+            self.response = response
+            self.status_code = getattr(response, "status_code", None)
+            if body_read:
+                self.bytes_received = len(response.content)
+            else:
+                length = response.headers.get("Content-Length")
+                self.bytes_received = int(length) if length else None
+            request = getattr(response, "request", None)
+            body = getattr(request, "body", None)
+            if body is not None and self.bytes_sent is None:
+                try:
+                    self.bytes_sent = len(body)
+                except TypeError:
+                    pass
+            _current.set(self)
+
+
+def current_event():
+    """Return the event of the last request of the current thread or task, or None."""
+    return _current.get()
+
+
+def timed_decode(response, decode):
+    """Call decode(), timing it in the event of response if the response has one."""
+    event = _current.get()
+    if event is None or event.response is not response:
+        return decode()
+    start = time.perf_counter()
+    try:
+        return decode()
+    finally:
+        event.add("decode", time.perf_counter() - start)
+        event.response = None
+        event.hooks.after_decode(event)
+
+
+class Hooks(object):
+    """Base of the instrumentation hooks, whose methods do nothing.
+
+    Subclasses override the methods they need. A hook must not raise.
+    """
+
+    def before_request(self, event):
+        """Called before the request is sent or looked up in the cache."""
+
+    def after_request(self, event):
+        """Called when the response is received, with the timings of the request."""
+
+    def after_decode(self, event):
+        """Called when a query class has decoded the response, with the decode timing."""
+
+
+class HookList(Hooks):
+    """Calls several hooks in turn."""
+
+    def __init__(self, hooks):
+        self.hooks = list(hooks)
+
+    def before_request(self, event):
+        for hook in self.hooks:
+            hook.before_request(event)
+
+    def after_request(self, event):
+        for hook in self.hooks:
+            hook.after_request(event)
+
+    def after_decode(self, event):
+        for hook in self.hooks:
+            hook.after_decode(event)
+
+
+def make_hooks(hooks):
+    """Return the hooks given to a client as one Hooks object, or None."""
+    if hooks is None or isinstance(hooks, Hooks):
+        return hooks
+    hooks = list(hooks)
+    if not hooks:
+        return None
+    return hooks[0] if len(hooks) == 1 else HookList(hooks)
+
+
+class PrometheusHooks(Hooks):
+    """Export the requests as Prometheus metrics.
+
+    Metrics, labelled by endpoint:
+        <namespace>_requests_total: counter, also labelled by status and cache.
+        <namespace>_request_seconds: histogram of the total time.
+        <namespace>_phase_seconds: histogram of the time of each phase, labelled by phase.
+        <namespace>_response_bytes_total: counter of the bytes received.
+        <namespace>_retries_total: counter of the requests sent again.
+
+    Attributes:
+        :param registry: The prometheus_client registry, the default is the global one.
+        :param namespace: The prefix of the metric names.
+    """
+
+    def __init__(self, registry=None, namespace="threatbook"):
+        if prometheus_client is None:
+            raise ImportError("PrometheusHooks requires prometheus_client, install it with "
+                              "pip install prometheus_client")
+        kwargs = {"namespace": namespace}
+        if registry is not None:
+            kwargs["registry"] = registry
+        self.requests = prometheus_client.Counter("requests_total", "ThreatBook API requests",
+                                                  ["endpoint", "status", "cache"], **kwargs)
+        self.seconds = prometheus_client.Histogram("request_seconds", "Total time of the requests",
+                                                   ["endpoint"], **kwargs)
+        self.phases = prometheus_client.Histogram("phase_seconds", "Time of the phases of the requests",
+                                                  ["endpoint", "phase"], **kwargs)
+        self.bytes = prometheus_client.Counter("response_bytes_total", "Bytes received", ["endpoint"], **kwargs)
+        self.retries = prometheus_client.Counter("retries_total", "Requests sent again", ["endpoint"], **kwargs)
+
+    def after_request(self, event):
+        endpoint = event.endpoint
+        status = "error" if event.status_code is None else str(event.status_code)
+        self.requests.labels(endpoint, status, event.cache or "").inc()
+        self.seconds.labels(endpoint).observe(event.timings["total"])
+        for phase, seconds in event.timings.items():
+            if phase != "total":
+                self.phases.labels(endpoint, phase).observe(seconds)
+        if event.bytes_received:
+            self.bytes.labels(endpoint).inc(event.bytes_received)
+        if event.retries:
+            self.retries.labels(endpoint).inc(event.retries)
+
+    def after_decode(self, event):
+        self.phases.labels(event.endpoint, "decode").observe(event.timings["decode"])
+
+
+class OpenTelemetryHooks(Hooks):
+    """Export every request as an OpenTelemetry span, and every decoding as a child span.
+
+    Attributes:
+        :param tracer: The tracer creating the spans, the default is the tracer
+            "threatbook_api" of the global tracer provider.
+    """
+
+    def __init__(self, tracer=None):
+        if otel_trace is None:
+            raise ImportError("OpenTelemetryHooks requires opentelemetry-api, install it with "
+                              "pip install opentelemetry-api")
+        self.tracer = tracer if tracer is not None else otel_trace.get_tracer("threatbook_api")
+
+    def before_request(self, event):
+        event.context["span"] = self.tracer.start_span(
+            "threatbook %s" % event.endpoint, kind=otel_trace.SpanKind.CLIENT,
+            attributes={"http.method": event.method, "http.url": event.url})
+
+    def after_request(self, event):
+        span = event.context.get("span")
+        if span is None:
+            return
+        if event.status_code is not None:
+            span.set_attribute("http.status_code", event.status_code)
+        if event.bytes_received is not None:
+            span.set_attribute("http.response_content_length", event.bytes_received)
+        if event.bytes_sent is not None:
+            span.set_attribute("http.request_content_length", event.bytes_sent)
+        if event.cache:
+            span.set_attribute("threatbook.cache", event.cache)
+        span.set_attribute("threatbook.attempts", event.attempts)
+        for phase, seconds in event.timings.items():
+            span.set_attribute("threatbook.%s_seconds" % phase, seconds)
+        if event.error is not None:
+            span.record_exception(event.error)
+            span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, str(event.error)))
+        span.end()
+
+    def after_decode(self, event):
+        span = event.context.get("span")
+        end = time.time_ns()
+        start = end - int(event.timings["decode"] * 1e9)
+        context = otel_trace.set_span_in_context(span) if span is not None else None
+        self.tracer.start_span("threatbook decode", context=context, start_time=start).end(end_time=end)
@@ -1,7 +1,9 @@
 # -*- coding:utf-8 -*-
-import json
 
-import  requests
+from threatbook_api.client import get_default_client
+from threatbook_api.endpoints import Endpoint, call
+
+ENDPOINT = Endpoint("https://x.threatbook.cn/api/v1/dns", "q")
 
 
 class Ioc(object):
@@ -13,30 +15,20 @@ class Ioc(object):
             the Analysis Platform website. As our business customer or 
             partner, we will deliver your corresponding apikey by mail.
         :param q:The IP or domain to be queried.
+        :param client: The Client whose connection pool is used for the requests.
+            The default is the shared client of the process.
+        :param typed: Whether every call returns a Result, a dict that keeps the raw
+            response, errors included, instead of a json string for the errors.
     """
 
-    def __init__(self,api_key):
+    def __init__(self, api_key, client=None, typed=False):
         self.api_key = api_key
-        self.msg = ""
-        self.data = {}
+        self.client = client if client is not None else get_default_client()
+        self.typed = typed
         self.response_code = -4
 
     def get_ioc(self,q):
         """Query the threat intelligence information of the domain.
         :param q: The domain to be queried.
         """
-        url = "https://x.threatbook.cn/api/v1/dns"
-        parameters = {"apikey": self.api_key, "q": q}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINT, q)
@@ -1,7 +1,40 @@
 # -*- coding:utf-8 -*-
-import json
 
-import requests
+from threatbook_api.client import get_default_client
+from threatbook_api.endpoints import Endpoint, call, fill
+
+URL = "https://x.threatbook.cn/api/v1/ip/query"
+
+# All the fields of the ip/query API.
+ALL_FIELDS = ["ip", "tags", "judgments", "intelligences", "samples", "cur_domains", "history_domains", "port"]
+
+
+def clean_ports(query, ret_json, ip, fields):
+    """Post-processor cleaning the port details of a successful response asking for the ports."""
+    if query.clean_ports and "port" in fields and ret_json.get("response_code") == 0:
+        ret_json["port"] = normalize_ports(ret_json["port"])
+    return ret_json
+
+
+def _endpoint(fields=None, empty=dict, post=()):
+    # The fields missing from a successful response are returned as empty().
+    return Endpoint(URL, "ip", fields=fields, post=[fill(empty, success_only=True)] + list(post))
+
+
+# The endpoint of each query method of IpAnalysis and AsyncIpAnalysis.
+ENDPOINTS = {
+    "get_all": _endpoint(",".join(ALL_FIELDS), post=[clean_ports]),
+    "get_ip": _endpoint("ip"),
+    "get_tags": _endpoint("tags"),
+    "get_judgments": _endpoint("judgments"),
+    "get_intelligences": _endpoint("intelligences"),
+    "get_samples": _endpoint("samples"),
+    "get_cur_domains": _endpoint("cur_domains"),
+    "get_history_domains": _endpoint("history_domains"),
+    "get_port": _endpoint("port"),
+    "get_fields": _endpoint(empty=str, post=[clean_ports]),
+}
+
 
 class IpAnalysis(object):
     """Obtain the IP address related geographical location information, bound domain information, threat type,
@@ -13,15 +46,23 @@ class IpAnalysis(object):
             the Analysis Platform website. As our business customer or 
             partner, we will deliver your corresponding apikey by mail.
         :param ip:The ip to be queried.
+        :param client: The Client whose connection pool is used for the requests.
+            The default is the shared client of the process.
+        :param typed: Whether every call returns a Result, a dict that keeps the raw
+            response, errors included, instead of a json string for the errors.
+        :param clean_ports: Whether get_all and get_fields clean the details of the ports,
+            the default is True. With False the ports are returned as received and
+            can be cleaned later with normalize_ports or normalize_results.
         
     """
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, client=None, typed=False, clean_ports=True):
         self.api_key = api_key
-        self.msg = ""
-        self.data = {}
+        self.client = client if client is not None else get_default_client()
+        self.typed = typed
+        self.clean_ports = clean_ports
         self.response_code = -4
-        self.url = "https://x.threatbook.cn/api/v1/ip/query"
+        self.url = URL
 
     def get_all(self, ip):
         """Get all the information related to the IP address.
@@ -39,237 +80,39 @@ class IpAnalysis(object):
             port:The relevant port information is a json array.
         
         """
-        url = self.url
-        fields = "ip,tags,judgments,intelligences,samples,cur_domains,history_domains,port"
-        parameters = {"apikey": self.api_key, "ip": ip, "field": fields}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                fields_list = ["ip", "tags", "judgments", "intelligences", "samples", "cur_domains", "history_domains",
-                               "port"]
-                if ret_json["response_code"] == 0:
-                    data2 = []
-                    for item in fields_list:
-                        if item not in ret_json:
-                            ret_json[item] = {}
-                    data1 = ret_json.get("port", {})
-                    for item in data1:
-                        if item["detail"]:
-                            item["detail"] = item.get("detail").replace("\x00", "").replace("\n", ",")
-                        data2.append(item)
-                    ret_json["port"] = data2
-                    return ret_json
-                else:
-                    return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_all"], ip)
 
     def get_ip(self, ip):
         """Get IP information related to the IP address."""
-
-        url = self.url
-        fields = "ip"
-        parameters = {"apikey": self.api_key, "ip": ip, "field": fields}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                fields_list = ["ip"]
-                if ret_json["response_code"] == 0:
-                    for item in fields_list:
-                        if item not in ret_json:
-                            ret_json[item] = {}
-                    return ret_json
-                else:
-                    return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_ip"], ip)
 
     def get_tags(self, ip):
         """Get tags information related to the IP address."""
-        url = self.url
-        fields = "tags"
-        parameters = {"apikey": self.api_key, "ip": ip, "field": fields}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                fields_list = ["tags"]
-                if ret_json["response_code"] == 0:
-                    for item in fields_list:
-                        if item not in ret_json:
-                            ret_json[item] = {}
-                    return ret_json
-                else:
-                    return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_tags"], ip)
 
     def get_judgments(self, ip):
         """Get judgments information related to the IP address."""
-        url = self.url
-        fields = "judgments"
-        parameters = {"apikey": self.api_key, "ip": ip, "field": fields}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                fields_list = ["judgments"]
-                if ret_json["response_code"] == 0:
-                    for item in fields_list:
-                        if item not in ret_json:
-                            ret_json[item] = {}
-                    return ret_json
-                else:
-                    return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_judgments"], ip)
 
     def get_intelligences(self, ip):
         """Get intelligences information related to the IP address."""
-        url = self.url
-        fields = "intelligences"
-        parameters = {"apikey": self.api_key, "ip": ip, "field": fields}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                fields_list = ["intelligences"]
-                if ret_json["response_code"] == 0:
-                    for item in fields_list:
-                        if item not in ret_json:
-                            ret_json[item] = {}
-                    return ret_json
-                else:
-                    return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_intelligences"], ip)
 
     def get_samples(self, ip):
         """Get samples information related to the IP address."""
-        url = self.url
-        fields = "samples"
-        parameters = {"apikey": self.api_key, "ip": ip, "field": fields}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                fields_list = ["samples"]
-                if ret_json["response_code"] == 0:
-                    for item in fields_list:
-                        if item not in ret_json:
-                            ret_json[item] = {}
-                    return ret_json
-                else:
-                    return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_samples"], ip)
 
     def get_cur_domains(self, ip):
         """Get cur_domains information related to the IP address."""
-        url = self.url
-        fields = "cur_domains"
-        parameters = {"apikey": self.api_key, "ip": ip, "field": fields}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                fields_list = ["cur_domains"]
-                if ret_json["response_code"] == 0:
-                    for item in fields_list:
-                        if item not in ret_json:
-                            ret_json[item] = {}
-                    return ret_json
-                else:
-                    return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_cur_domains"], ip)
 
     def get_history_domains(self, ip):
         """Get history_domains information related to the IP address."""
-        url = self.url
-        fields = "history_domains"
-        parameters = {"apikey": self.api_key, "ip": ip, "field": fields}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                fields_list = ["history_domains"]
-                if ret_json["response_code"] == 0:
-                    for item in fields_list:
-                        if item not in ret_json:
-                            ret_json[item] = {}
-                    return ret_json
-                else:
-                    return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_history_domains"], ip)
 
     def get_port(self, ip):
         """Get port information related to the IP address."""
-        url = self.url
-        fields = "port"
-        parameters = {"apikey": self.api_key, "ip": ip, "field": fields}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                fields_list = ["port"]
-                if ret_json["response_code"] == 0:
-                    for item in fields_list:
-                        if item not in ret_json:
-                            ret_json[item] = {}
-                    return ret_json
-                else:
-                    return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_port"], ip)
 
     def get_fields(self,ip,fields):
         """Get information about the specified field.
@@ -287,32 +130,39 @@ class IpAnalysis(object):
                     the value is an array, and each item is a domain.
                 port:The relevant port information is a json array.
         """
-        url = self.url
-        parameters = {"apikey": self.api_key, "ip": ip, "field": fields}
-        fields_list = fields.split(',')
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                if ret_json["response_code"] == 0:
-                    data2 = []
-                    for item in fields_list:
-                        if item not in ret_json:
-                            ret_json[item] = ""
-                    if "port" in fields_list:
-                        data1 = ret_json.get("port", {})
-                        for item in data1:
-                            if item["detail"]:
-                                item["detail"] = item.get("detail").replace("\x00", "").replace("\n", ",")
-                            data2.append(item)
-                        ret_json["port"] = data2
-                    return ret_json
-                else:
-                    return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_fields"], ip, fields)
+
+
+def normalize_ports(ports):
+    """Return the port objects of an IP with their details cleaned.
+
+    The NUL bytes of a detail are dropped and its newlines turned into commas.
+    A port whose detail holds any of them is replaced by a copy with the cleaned
+    detail, the other ports are kept as they are, and the given list and port
+    objects are left unchanged.
+    """
+    cleaned = []
+    for item in ports or []:
+        detail = item.get("detail") if isinstance(item, dict) else None
+        if isinstance(detail, str) and ("\x00" in detail or "\n" in detail):
+            # str.replace runs in C and beats str.translate, which maps every character.
+            item = dict(item, detail=detail.replace("\x00", "").replace("\n", ","))
+        cleaned.append(item)
+    return cleaned
+
+
+def normalize_results(results):
+    """Clean the port details of many results of get_all or get_fields.
+
+    :param results: An iterable of results, e.g. of an IpAnalysis created with
+        clean_ports=False.
+    :return: Returns a list of the results. A successful result with ports is
+        replaced by a shallow copy holding the cleaned ports, the others are kept.
+    """
+    normalized = []
+    for ret_json in results:
+        if isinstance(ret_json, dict) and ret_json.get("response_code") == 0 and ret_json.get("port"):
+            ret_json = ret_json.copy()
+            ret_json["port"] = normalize_ports(ret_json["port"])
+        normalized.append(ret_json)
+    return normalized
@@ -1,6 +1,42 @@
 # -*- coding:utf-8 -*-
-import json
-import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from threatbook_api.client import get_default_client
+from threatbook_api.endpoints import Endpoint, call
+from threatbook_api.result import encode
+
+URL = "https://x.threatbook.cn/api/v2/ip_reputation"
+
+# The maximum number of IPs of one ip_reputation request.
+BATCH_SIZE = 10
+VIEWS = ("now", "expired", "all")
+
+
+def _view(view):
+    """Return a post-processor keeping the given view of the information of every IP.
+
+    The response code, and the message of a failure, are kept so a failed query
+    stays a failure, and in typed mode so are its raw body and status code.
+    """
+    def post(query, ret_json, ip, fields):
+        data1 = ret_json.get("data")
+        data = {}
+        if isinstance(data1, dict):
+            for i in data1:
+                data[i] = data1[i].get(view, {}) if isinstance(data1[i], dict) else data1[i]
+        code = ret_json.get("response_code")
+        res = {"data": data, "msg": "" if code == 0 else ret_json.get("msg", ""), "response_code": code}
+        return encode(res, query.typed, getattr(ret_json, "status_code", None), getattr(ret_json, "raw", None))
+    return post
+
+
+# The endpoint of each query method of IpReputation and AsyncIpReputation.
+ENDPOINTS = {
+    "get_all": Endpoint(URL, "ip"),
+    "get_now": Endpoint(URL, "ip", post=[_view("now")]),
+    "get_expired": Endpoint(URL, "ip", post=[_view("expired")]),
+}
 
 
 class IpReputation(object):
@@ -13,75 +49,87 @@ class IpReputation(object):
             the Analysis Platform website. As our business customer or 
             partner, we will deliver your corresponding apikey by mail.
         :param ip:The IP to be queried can be multiple, separated by commas, up to 10.
+        :param client: The Client whose connection pool is used for the requests.
+            The default is the shared client of the process.
+        :param typed: Whether every call returns a Result, a dict that keeps the raw
+            response, errors included, instead of a json string for the errors.
      """
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, client=None, typed=False):
         self.api_key = api_key
-        self.msg = ""
-        self.data = {}
+        self.client = client if client is not None else get_default_client()
+        self.typed = typed
         self.response_code = -4
-        self.url = "https://x.threatbook.cn/api/v2/ip_reputation"
+        self.url = URL
 
     def get_all(self, ip):
         """Get current and outdated intelligence information for the IP."""
-        url = self.url
-        parameters = {"apikey": self.api_key, "ip": ip}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                return ret_json
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_all"], ip)
 
     def get_now(self, ip):
         """Get the current valid information of the IP."""
-        url = self.url
-        parameters = {"apikey": self.api_key, "ip": ip}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                data1 = ret_json.get("data", {})
-                for i in data1:
-                    data_now = data1[i].get("now", {})
-                    self.data[i] = data_now
-                res = {"data": self.data, "msg": self.msg, "response_code": 0}
-                return json.dumps(res)
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_now"], ip)
 
     def get_expired(self, ip):
         """Get expired intelligence information of the IP."""
-        url = self.url
-        parameters = {"apikey": self.api_key, "ip": ip}
-        try:
-            response = requests.post(url, parameters)
-        except Exception as e:
-            print(e)
-        else:
-            if response.status_code == 200:
-                ret_json = json.loads(response.text)
-                data1 = ret_json.get("data", {})
-                for i in data1:
-                    data_now = data1[i].get("expired", {})
-                    self.data[i] = data_now
-                res = {"data": self.data, "msg": self.msg, "response_code": 0}
-                return json.dumps(res)
-
-            else:
-                self.msg = response.status_code, "not fount"
-                res = {"data": self.data, "msg": self.msg, "response_code": self.response_code}
-                return json.dumps(res)
+        return call(self, ENDPOINTS["get_expired"], ip)
+
+    def get_many(self, ips, view="now", max_workers=4):
+        """Get the intelligence information of any number of IPs, 10 IPs per request.
+
+        The input is read lazily, duplicate IPs are queried once, and up to
+        max_workers batches are sent at the same time while the results of
+        the earlier ones are consumed.
+        :param ips: An iterable of IPs.
+        :param view: "now" for the current valid information, "expired" for the
+            expired intelligence information, "all" for both of them.
+        :param max_workers: The maximum number of batches sent at the same time.
+        :return: Yields (ip, result) tuples in the order of the input. The result
+            is the information of the IP, or the error result of its batch.
+        """
+        if view not in VIEWS:
+            raise ValueError("view must be one of %s" % ", ".join(VIEWS))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch in batch_ips(ips):
+                pending.append((batch, executor.submit(self.get_all, ",".join(batch))))
+                # Keep the workers busy while the oldest batch is handed out.
+                if len(pending) > max_workers:
+                    batch, future = pending.popleft()
+                    for item in split_reputation(batch, future.result(), view):
+                        yield item
+            while pending:
+                batch, future = pending.popleft()
+                for item in split_reputation(batch, future.result(), view):
+                    yield item
+
+
+def batch_ips(ips, size=BATCH_SIZE):
+    """Split an iterable of IPs into lists of at most size unique IPs."""
+    seen = set()
+    batch = []
+    for ip in ips:
+        ip = ip.strip()
+        if not ip or ip in seen:
+            continue
+        seen.add(ip)
+        batch.append(ip)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 
+def split_reputation(batch, ret_json, view):
+    """Split the response of a batch into (ip, result) tuples of the given view."""
+    if not isinstance(ret_json, dict) or ret_json.get("response_code") != 0:
+        for ip in batch:
+            yield ip, ret_json
+        return
+    data = ret_json.get("data", {})
+    for ip in batch:
+        item = data.get(ip, {})
+        if view != "all":
+            item = item.get(view, {})
+        yield ip, item
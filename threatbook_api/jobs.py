@@ -0,0 +1,174 @@
+# -*- coding:utf-8 -*-
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from threatbook_api.result import redact
+
+DONE = "done"
+FAILED = "failed"
+
+
+def is_success(result):
+    """Default success test of a lookup: a decoded response with a non-negative response_code."""
+    return isinstance(result, dict) and result.get("response_code", -1) >= 0
+
+
+class Job(object):
+    """Resumable bulk lookup that records its progress in a SQLite file.
+
+    Every indicator is passed to func, e.g. IpAnalysis(api_key).get_all, on a
+    thread pool. The state of each indicator, done or failed with the number of
+    attempts, and the position reached in the input are committed as the run
+    goes. A run started again with the same path skips the part of the input
+    already handled, never queries an indicator that succeeded, and queries
+    the failed ones again while they have attempts left.
+
+    Attributes:
+        :param path: The path of the progress database, created if it does not exist.
+        :param func: The lookup called with each indicator.
+        :param workers: The number of lookups run at the same time.
+        :param max_attempts: The number of times a failing indicator is tried, over all runs.
+        :param success: The function telling whether a result succeeded, the default
+            is is_success.
+        :param commit_every: The number of finished indicators between two commits.
+    """
+
+    def __init__(self, path, func, workers=8, max_attempts=3, success=is_success, commit_every=100):
+        self.path = os.path.abspath(path)
+        self.func = func
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.success = success
+        self.commit_every = commit_every
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, status TEXT, "
+                              "attempts INTEGER, error TEXT, updated REAL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def _meta(self, name):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def _state(self, key):
+        row = self.conn.execute("SELECT status, attempts FROM items WHERE key = ?", (key,)).fetchone()
+        return row if row else (None, 0)
+
+    def _wanted(self, key):
+        status, attempts = self._state(key)
+        return status != DONE and attempts < self.max_attempts
+
+    def _call(self, key):
+        try:
+            result = self.func(key)
+        except Exception as e:
+            return None, redact(repr(e))
+        if self.success(result):
+            return result, None
+        return result, "unsuccessful result: %r" % (result,)
+
+    def _record(self, key, error):
+        status, attempts = self._state(key)
+        self.conn.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)",
+                          (key, FAILED if error else DONE, attempts + 1, error, time.time()))
+
+    def _run(self, records, stats, on_result, cursor=None):
+        # records yields (key, position after the record); the position is saved
+        # under the cursor name once every record before it is finished. A key
+        # repeated while its first lookup is in flight is skipped, it is not
+        # recorded yet so _wanted cannot tell.
+        pending = deque()
+        in_flight = set()
+        settled = 0
+
+        def settle():
+            key, position, future = pending.popleft()
+            if future is not None:
+                result, error = future.result()
+                in_flight.discard(key)
+                self._record(key, error)
+                if error:
+                    stats["failed"] += 1
+                else:
+                    stats["done"] += 1
+                    if on_result is not None:
+                        on_result(key, result)
+            if cursor is not None:
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (cursor, position))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for key, position in records:
+                if key and key not in in_flight and self._wanted(key):
+                    in_flight.add(key)
+                    pending.append((key, position, executor.submit(self._call, key)))
+                else:
+                    stats["skipped"] += 1
+                    pending.append((key, position, None))
+                while pending and (len(pending) > self.workers * 2 or pending[0][2] is None):
+                    settle()
+                    settled += 1
+                    if settled % self.commit_every == 0:
+                        self.conn.commit()
+            while pending:
+                settle()
+        self.conn.commit()
+
+    def retry_failed(self, on_result=None):
+        """Query again the failed indicators that have attempts left."""
+        stats = {"done": 0, "failed": 0, "skipped": 0}
+        keys = [row[0] for row in self.conn.execute(
+            "SELECT key FROM items WHERE status = ? AND attempts < ?", (FAILED, self.max_attempts))]
+        self._run(((key, None) for key in keys), stats, on_result)
+        return stats
+
+    def run(self, indicators, on_result=None):
+        """Look up an iterable of indicators, resuming after the ones a previous run handled.
+
+        The records before the saved cursor are read and dropped without a lookup.
+        :param indicators: An iterable of indicators, in the same order on every run.
+        :param on_result: Called with (indicator, result) for every successful lookup.
+        :return: Returns the number of done, failed and skipped indicators of this run.
+        """
+        stats = self.retry_failed(on_result)
+        start = self._meta("cursor")
+
+        def records():
+            for position, key in enumerate(indicators, 1):
+                if position > start:
+                    yield key.strip(), position
+
+        self._run(records(), stats, on_result, "cursor")
+        return stats
+
+    def run_file(self, path, on_result=None):
+        """Look up the indicators of a file, one per line.
+
+        The byte offset reached in the file is saved, so a resumed run seeks
+        straight to it instead of reading the handled part of the file again.
+        :return: Returns the number of done, failed and skipped indicators of this run.
+        """
+        stats = self.retry_failed(on_result)
+        with open(path, "rb") as f:
+            f.seek(self._meta("offset"))
+
+            def records():
+                offset = f.tell()
+                for line in iter(f.readline, b""):
+                    offset += len(line)
+                    yield line.decode("utf-8").strip(), offset
+
+            self._run(records(), stats, on_result, "offset")
+        return stats
+
+    def progress(self):
+        """Return the number of done and failed indicators recorded."""
+        counts = dict(self.conn.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall())
+        return {"done": counts.get(DONE, 0), "failed": counts.get(FAILED, 0),
+                "cursor": self._meta("cursor"), "offset": self._meta("offset")}
+
+    def close(self):
+        self.conn.close()
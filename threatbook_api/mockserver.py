@@ -0,0 +1,369 @@
+# -*- coding:utf-8 -*-
+"""A local stand-in for the ThreatBook API, for tests and benchmarks.
+
+The server answers the endpoints used by the query classes with generated
+responses of the same shape as the real ones, after a configurable latency,
+and fails a configurable share of the requests. Point a client at it with
+Client(base_url=server.url). It can also be run on its own:
+
+    python -m threatbook_api.mockserver --port 8080 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+REPORT_SECTIONS = ("summary", "ioc", "system", "network", "signature", "static", "dropped", "pstree",
+                   "multiengines")
+CARRIERS = ("China Telecom", "China Unicom", "Amazon.com", "Google LLC", "DigitalOcean", "OVH SAS")
+COUNTRIES = (("China", "Beijing", "Beijing"), ("United States", "California", "San Jose"),
+             ("Germany", "Hesse", "Frankfurt"), ("Singapore", "Singapore", "Singapore"))
+JUDGMENTS = ("IDC", "Scanner", "Spam", "Botnet", "C2", "Proxy", "Brute Force", "Exploit")
+TAGS = ("DarkHotel", "APT28", "Lazarus", "Mirai", "Emotet")
+
+
+class _Random(random.Random):
+    """Random generator seeded by an indicator, so an indicator always gets the same data."""
+
+    def __init__(self, *parts):
+        digest = hashlib.md5("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+        super(_Random, self).__init__(int(digest, 16))
+
+    def sample_of(self, population, upto):
+        return self.sample(population, self.randint(0, min(upto, len(population))))
+
+
+def _location(rnd):
+    country, province, city = rnd.choice(COUNTRIES)
+    return {"country": country, "province": province, "city": city,
+            "lng": "%.4f" % rnd.uniform(-180, 180), "lat": "%.4f" % rnd.uniform(-90, 90)}
+
+
+def _domain(rnd):
+    return "%s.example.%s" % ("".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(8)),
+                              rnd.choice(("com", "net", "org", "cn")))
+
+
+def _ip(rnd):
+    return ".".join(str(rnd.randint(1, 254)) for _ in range(4))
+
+
+def ip_data(ip, size):
+    """Return the fields of the ip/query response of an IP, with size items per list."""
+    rnd = _Random("ip", ip)
+    return {
+        "ip": {"ip": ip, "carrier": rnd.choice(CARRIERS), "location": _location(rnd)},
+        "tags": rnd.sample_of(TAGS, 2),
+        "judgments": rnd.sample_of(JUDGMENTS, 3),
+        "intelligences": {"threatbook_lab": [
+            {"source": "ThreatBook Labs", "confidence": rnd.randint(50, 100), "expired": rnd.random() < 0.3,
+             "intel_tags": [], "find_time": "2019-0%d-1%d 00:00:00" % (rnd.randint(1, 9), rnd.randint(0, 9)),
+             "intel_types": rnd.sample_of(JUDGMENTS, 2)} for _ in range(size)]},
+        "samples": [{"sha256": hashlib.sha256(("%s-%d" % (ip, i)).encode()).hexdigest(),
+                     "scan_time": "2019-01-01 00:00:00", "ratio": "%d/25" % rnd.randint(0, 25),
+                     "malware_type": rnd.choice(JUDGMENTS), "malware_family": rnd.choice(TAGS)}
+                    for i in range(size // 2)],
+        "cur_domains": [{"domain": _domain(rnd), "judgments": rnd.sample_of(JUDGMENTS, 2)} for _ in range(size)],
+        "history_domains": {"2019-01-%02d" % (i + 1): [_domain(rnd)] for i in range(size)},
+        "port": [{"port": port, "module": "http", "product": "nginx", "version": "1.%d" % rnd.randint(0, 20),
+                  "detail": "HTTP/1.1 200 OK\x00\nServer: nginx\nContent-Type: text/html\n"}
+                 for port in rnd.sample(range(1, 65535), size)],
+    }
+
+
+def domain_data(domain, size):
+    """Return the fields of the domain/query response of a domain, with size items per list."""
+    rnd = _Random("domain", domain)
+    whois = {"registrar_name": rnd.choice(("GoDaddy.com, LLC", "Alibaba Cloud", "NameCheap, Inc.")),
+             "registrant_name": "Domain Admin", "registrant_email": "admin@" + domain,
+             "registrant_company": "Example Inc.", "registrant_address": "Example Road",
+             "registrant_phone": "+1.5550100", "cdate": "2015-01-01", "udate": "2019-01-01", "edate": "2025-01-01",
+             "name_server": ["ns1." + domain, "ns2." + domain]}
+    return {
+        "cur_whois": [whois],
+        "history_whoises": [dict(whois, registrar_name=rnd.choice(CARRIERS)) for _ in range(size // 2)],
+        "cur_ips": [{"ip": _ip(rnd), "carrier": rnd.choice(CARRIERS), "location": _location(rnd)}
+                    for _ in range(max(1, size // 4))],
+        "history_ips": [{"date": "2019-01-%02d" % (i % 28 + 1), "ips": [_ip(rnd)]} for i in range(size)],
+        "tags": rnd.sample_of(TAGS, 2),
+        "judgments": rnd.sample_of(JUDGMENTS, 3),
+        "intelligences": {"threatbook_lab": [{"source": "ThreatBook Labs", "confidence": rnd.randint(50, 100),
+                                              "intel_types": rnd.sample_of(JUDGMENTS, 2)} for _ in range(size)]},
+        "samples": [{"sha256": hashlib.sha256(("%s-%d" % (domain, i)).encode()).hexdigest()}
+                    for i in range(size // 2)],
+        "domains_4_email": [_domain(rnd) for _ in range(size)],
+        "sub_domains": ["%d.%s" % (i, domain) for i in range(size)],
+    }
+
+
+def reputation_data(ip, size):
+    """Return the ip_reputation entry of an IP."""
+    rnd = _Random("reputation", ip)
+
+    def view():
+        return {"severity": rnd.choice(("info", "low", "medium", "high", "critical")),
+                "judgments": rnd.sample_of(JUDGMENTS, 3), "tags_classes": [],
+                "basic": {"carrier": rnd.choice(CARRIERS), "location": _location(rnd)},
+                "asn": {"rank": rnd.randint(0, 4), "info": rnd.choice(CARRIERS), "number": rnd.randint(1, 65535)},
+                "scene": rnd.choice(("", "CDN", "Gateway", "University")),
+                "confidence_level": rnd.choice(("low", "medium", "high")), "is_malicious": rnd.random() < 0.5,
+                "update_time": "2019-01-01 00:00:00"}
+
+    return {"now": view(), "expired": view()}
+
+
+def report_section(sha256, section, size):
+    """Return the data of a sandbox report section of a sample."""
+    rnd = _Random("report", sha256, section)
+    if section == "summary":
+        return {"summary": {"sample_sha256": sha256, "file_name": sha256[:8] + ".exe", "file_type": "EXEx86",
+                            "sandbox_type": "win7_sp1_enx86_office2013", "submit_time": "2019-01-01 00:00:00",
+                            "threat_level": rnd.choice(("clean", "suspicious", "malicious")),
+                            "threat_score": rnd.randint(0, 100), "multi_engines": "%d/25" % rnd.randint(0, 25),
+                            "tag": {"s": rnd.sample_of(TAGS, 2), "x": rnd.sample_of(JUDGMENTS, 2)}}}
+    if section == "network":
+        return {"network": {
+            "hosts": [_ip(rnd) for _ in range(size)],
+            "dns": [{"request": _domain(rnd), "answers": [{"type": "A", "data": _ip(rnd)}]} for _ in range(size)],
+            "tcp": [{"src": "192.168.1.2", "dst": _ip(rnd), "sport": rnd.randint(1024, 65535), "dport": 443,
+                     "time": rnd.random()} for _ in range(size * 10)],
+            "udp": [{"src": "192.168.1.2", "dst": _ip(rnd), "sport": rnd.randint(1024, 65535), "dport": 53,
+                     "time": rnd.random()} for _ in range(size * 2)],
+            "http": [{"host": _domain(rnd), "uri": "/index.php?id=%d" % i, "method": "GET"} for i in range(size)]}}
+    if section == "dropped":
+        return {"dropped": [{"name": "file%d.tmp" % i, "sha256": hashlib.sha256(b"%d" % i).hexdigest(),
+                             "size": rnd.randint(1, 1 << 20), "type": "data"} for i in range(size * 5)]}
+    if section == "multiengines":
+        return {"multiengines": {"result": {"engine%d" % i: rnd.choice(("safe", "Trojan.Generic"))
+                                            for i in range(25)}}}
+    return {section: [{"id": i, "name": "%s-%d" % (section, i), "pid": rnd.randint(100, 9999),
+                       "detail": "x" * 64} for i in range(size * 5)]}
+
+
+def parse_multipart(content_type, body):
+    """Return the form fields and the files of a multipart/form-data body, as two dicts."""
+    message = BytesParser(policy=HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body)
+    fields, files = {}, {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        content = part.get_payload(decode=True)
+        if part.get_filename() is None:
+            fields[name] = content.decode("utf-8")
+        else:
+            files[name] = content
+    return fields, files
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are written separately, without TCP_NODELAY the body
+    # waits for the delayed ACK of the client.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        self._answer(parts.path, {key: value[0] for key, value in parse_qs(parts.query).items()})
+
+    def do_POST(self):
+        body = self._read_body()
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            params, files = parse_multipart(content_type, body)
+            self._answer(urlsplit(self.path).path, params, files)
+        else:
+            params = {key: value[0] for key, value in parse_qs(body.decode("utf-8")).items()}
+            self._answer(urlsplit(self.path).path, params)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if not size:
+                self.rfile.readline()
+                return b"".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _answer(self, path, params, files=None):
+        mock = self.server.mock
+        status, payload = mock.handle(path, params, files)
+        content = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class MockServer(object):
+    """Local HTTP server answering the ThreatBook API endpoints with generated data.
+
+    Every response is delayed by latency seconds, plus up to jitter seconds at
+    random. A share error_rate of the requests is answered with a 500 or a 429
+    instead. The lists of the responses hold about size items each, so size
+    controls the payload sizes. The data of an indicator is always the same.
+
+    Attributes:
+        :param host: The address to listen on.
+        :param port: The port to listen on, 0 picks a free port.
+        :param latency: The minimum delay of a response, in seconds.
+        :param jitter: The maximum random delay added to latency, in seconds.
+        :param error_rate: The share of the requests answered with an HTTP error.
+        :param size: The number of items of the lists of the responses.
+        :param seed: The seed of the random errors and delays.
+        :param cache_size: The number of generated responses kept to answer the same
+            request again without generating it, so that the server is not the
+            bottleneck of a benchmark.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, size=10, seed=None,
+                 cache_size=10000):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.size = size
+        self.requests = 0
+        self.errors = 0
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def handle(self, path, params, files=None):
+        """Return the status and the payload of a request.
+
+        :param params: The query string or form fields of the request.
+        :param files: The files of a multipart upload, by field name.
+        """
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+            failed = self.error_rate and self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+                status = self._random.choice((429, 500))
+        if delay:
+            time.sleep(delay)
+        if failed:
+            return status, b"error"
+        if not params.get("apikey"):
+            return 200, {"response_code": -1, "msg": "Invalid Access IP"}
+        if files:
+            # Uploads are never the same twice, they are not cached.
+            return 200, self._route(path, params, files)
+        key = (path, tuple(sorted(item for item in params.items() if item[0] != "apikey")))
+        with self._lock:
+            content = self._cache.get(key)
+            if content is not None:
+                self._cache.move_to_end(key)
+                return 200, content
+        content = json.dumps(self._route(path, params)).encode("utf-8")
+        with self._lock:
+            self._cache[key] = content
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return 200, content
+
+    def _route(self, path, params, files=None):
+        size = self.size
+        if path == "/api/v1/ip/query":
+            return self._fields(ip_data(params.get("ip", ""), size), params.get("field"))
+        if path == "/api/v1/domain/query":
+            return self._fields(domain_data(params.get("domain", ""), size), params.get("field"))
+        if path == "/api/v2/ip_reputation":
+            ips = [ip for ip in params.get("ip", "").split(",") if ip]
+            return {"data": {ip: reputation_data(ip, size) for ip in ips}, "response_code": 0, "msg": "Success"}
+        if path == "/api/v1/dns":
+            return {"response_code": 0, "msg": "Success",
+                    "data": {"ips": [], "domains": [], "q": params.get("q", "")}}
+        if path == "/api/v1/domain4email/query":
+            rnd = _Random("email", params.get("email", ""))
+            return {"response_code": 0, "msg": "Success", "data": [_domain(rnd) for _ in range(size)]}
+        if path == "/api/v1/file/fetch_file_legal_ca":
+            return {"response_code": 1, "msg": "Success", "LegalIssuer": "Example Software Inc.",
+                    "cas": [{"subject": "Example CA %d" % i} for i in range(3)]}
+        if path == "/api/v2/file/upload":
+            sha256 = hashlib.sha256((files or {}).get("file", b"")).hexdigest()
+            return {"response_code": 0, "msg": "OK", "data": {
+                "sha256": sha256, "permalink": "https://s.threatbook.cn/report/file/%s" % sha256}}
+        if path.startswith("/api/v2/file/report"):
+            sha256 = params.get("sha256", "")
+            section = path[len("/api/v2/file/report"):].strip("/")
+            if section and section not in REPORT_SECTIONS:
+                return {"response_code": -1, "msg": "Invalid section"}
+            data = {}
+            for name in [section] if section else REPORT_SECTIONS:
+                data.update(report_section(sha256, name, size))
+            return {"response_code": 0, "msg": "OK", "data": data}
+        return {"response_code": -1, "msg": "Unknown API"}
+
+    @staticmethod
+    def _fields(data, fields):
+        wanted = fields.split(",") if fields else list(data)
+        ret_json = {field: data[field] for field in wanted if field in data}
+        ret_json.update({"response_code": 0, "msg": "Success"})
+        return ret_json
+
+    def start(self):
+        """Serve the requests in a background thread and return the server."""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="threatbook-mock")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m threatbook_api.mockserver",
+                                     description="Serve a local stand-in of the ThreatBook API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="minimum delay of a response in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum random delay added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the requests failing with 429/500")
+    parser.add_argument("--size", type=int, default=10, help="number of items of the lists of the responses")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+    server = MockServer(args.host, args.port, args.latency, args.jitter, args.error_rate, args.size, args.seed)
+    print("Serving the mock ThreatBook API on %s" % server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+# -*- coding:utf-8 -*-
+"""Compact result models for holding many results in memory.
+
+A model keeps the response body as zlib compressed json bytes, about a quarter
+of their size, and parses it the first time one of its attributes is read.
+The scalar fields are then stored in slots, the lists as tuples, and the
+strings that repeat across results, such as carriers, countries, tags and
+judgments, are interned so that all the results share one copy of them. The large nested parts of a response are not kept
+parsed and are decoded from the bytes each time they are read.
+"""
+import json
+import sys
+import zlib
+
+from threatbook_api.decoder import loads
+from threatbook_api.ip_analysis_query import normalize_ports
+
+
+def _compact(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _strings(values):
+    """Return a list as a tuple, with its strings interned."""
+    if not values:
+        return ()
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+    return tuple(_intern(value) for value in values)
+
+
+def _location(location):
+    """Return the interned country, province and city of a location object."""
+    if not isinstance(location, dict):
+        return None, None, None
+    return _intern(location.get("country")), _intern(location.get("province")), _intern(location.get("city"))
+
+
+class Model(object):
+    """Base of the result models, a lazily parsed json object.
+
+    Attributes:
+        :param raw: The json body of the result, bytes or str.
+    """
+
+    __slots__ = ("_raw",)
+    # The slots filled by _load the first time one of them is read.
+    FIELDS = ()
+    # The zlib level of the stored body, level 1 costs less than decoding the body.
+    LEVEL = 1
+
+    def __init__(self, raw):
+        self._raw = zlib.compress(raw.encode("utf-8") if isinstance(raw, str) else raw, self.LEVEL)
+
+    @classmethod
+    def from_result(cls, result):
+        """Build a model from the return value of a query.
+
+        The raw body of a Result of the typed mode is compressed without being
+        encoded again, a dict is encoded to compact json first and a json
+        string is used as it is.
+        """
+        raw = getattr(result, "raw", None)
+        if raw is None:
+            raw = result if isinstance(result, (bytes, str)) else _compact(result)
+        return cls(raw)
+
+    @property
+    def raw(self):
+        """The json body of the result, decompressed."""
+        return zlib.decompress(self._raw)
+
+    def to_dict(self):
+        """Decode the whole result again into a new dict."""
+        return loads(self.raw)
+
+    def _load(self, data):
+        raise NotImplementedError
+
+    def __getattr__(self, name):
+        # Only called for a slot that is not set yet.
+        if name in self.FIELDS:
+            self._load(self.to_dict())
+            return object.__getattribute__(self, name)
+        raise AttributeError("%s object has no attribute %r" % (type(self).__name__, name))
+
+
+class IpResult(Model):
+    """The result of IpAnalysis.get_all.
+
+    Attributes:
+        :param raw: The json body of the result, bytes or str.
+    """
+
+    __slots__ = ("response_code", "ip", "carrier", "country", "province", "city", "tags", "judgments")
+    FIELDS = __slots__
+
+    def _load(self, data):
+        info = data.get("ip") or {}
+        self.response_code = data.get("response_code")
+        self.ip = info.get("ip")
+        self.carrier = _intern(info.get("carrier"))
+        self.country, self.province, self.city = _location(info.get("location"))
+        self.tags = _strings(data.get("tags"))
+        self.judgments = _strings(data.get("judgments"))
+
+    @property
+    def intelligences(self):
+        return self.to_dict().get("intelligences")
+
+    @property
+    def samples(self):
+        return self.to_dict().get("samples")
+
+    @property
+    def cur_domains(self):
+        return self.to_dict().get("cur_domains")
+
+    @property
+    def history_domains(self):
+        return self.to_dict().get("history_domains")
+
+    @property
+    def port(self):
+        """The ports, with their details cleaned when they are read."""
+        return normalize_ports(self.to_dict().get("port"))
+
+    def __repr__(self):
+        return "<IpResult %s>" % self.ip
+
+
+class ReputationResult(Model):
+    """The reputation of one IP, as yielded by IpReputation.get_many.
+
+    Attributes:
+        :param raw: The json body of the result, bytes or str.
+    """
+
+    __slots__ = ("severity", "judgments", "tags_classes", "carrier", "country", "province", "city",
+                 "scene", "confidence_level", "is_malicious", "update_time")
+    FIELDS = __slots__
+
+    def _load(self, data):
+        basic = data.get("basic") or {}
+        self.severity = _intern(data.get("severity"))
+        self.judgments = _strings(data.get("judgments"))
+        self.tags_classes = data.get("tags_classes") or ()
+        self.carrier = _intern(basic.get("carrier"))
+        self.country, self.province, self.city = _location(basic.get("location"))
+        self.scene = _intern(data.get("scene"))
+        self.confidence_level = _intern(data.get("confidence_level"))
+        self.is_malicious = data.get("is_malicious")
+        self.update_time = data.get("update_time")
+
+    @property
+    def asn(self):
+        return self.to_dict().get("asn")
+
+    def __repr__(self):
+        return "<ReputationResult %s>" % self.severity
+
+
+class WhoisResult(Model):
+    """One WHOIS record of a domain, an item of its cur_whois or history_whoises.
+
+    The cdate, udate and edate fields are the creation, update and expiration
+    dates of the registration.
+
+    Attributes:
+        :param raw: The json body of the result, bytes or str.
+    """
+
+    __slots__ = ("registrar_name", "registrant_name", "registrant_email", "registrant_company",
+                 "registrant_address", "registrant_phone", "cdate", "udate", "edate", "name_server")
+    FIELDS = __slots__
+
+    def _load(self, data):
+        self.registrar_name = _intern(data.get("registrar_name"))
+        self.registrant_name = data.get("registrant_name")
+        self.registrant_email = data.get("registrant_email")
+        self.registrant_company = data.get("registrant_company")
+        self.registrant_address = data.get("registrant_address")
+        self.registrant_phone = data.get("registrant_phone")
+        self.cdate = data.get("cdate")
+        self.udate = data.get("udate")
+        self.edate = data.get("edate")
+        self.name_server = _strings(data.get("name_server"))
+
+    def __repr__(self):
+        return "<WhoisResult %s>" % self.registrar_name
+
+
+class DomainResult(Model):
+    """The result of DomainAnalysis.get_all or get_fields.
+
+    Attributes:
+        :param raw: The json body of the result, bytes or str.
+    """
+
+    __slots__ = ("response_code", "tags", "judgments", "sub_domains", "domains_4_email")
+    FIELDS = __slots__
+
+    def _load(self, data):
+        self.response_code = data.get("response_code")
+        self.tags = _strings(data.get("tags"))
+        self.judgments = _strings(data.get("judgments"))
+        self.sub_domains = tuple(data.get("sub_domains") or ())
+        self.domains_4_email = tuple(data.get("domains_4_email") or ())
+
+    @property
+    def whois(self):
+        """The first record of cur_whois, a json array, as a WhoisResult, or None."""
+        whois = self.to_dict().get("cur_whois")
+        if isinstance(whois, list):
+            whois = whois[0] if whois else None
+        return WhoisResult(_compact(whois)) if isinstance(whois, dict) else None
+
+    @property
+    def history_whoises(self):
+        return self.to_dict().get("history_whoises")
+
+    @property
+    def cur_ips(self):
+        return self.to_dict().get("cur_ips")
+
+    @property
+    def history_ips(self):
+        return self.to_dict().get("history_ips")
+
+    @property
+    def intelligences(self):
+        return self.to_dict().get("intelligences")
+
+    @property
+    def samples(self):
+        return self.to_dict().get("samples")
+
+    def __repr__(self):
+        return "<DomainResult %s>" % (self.tags,)
+
+
+class SandboxSummary(Model):
+    """The result of Report.get_summary.
+
+    Attributes:
+        :param raw: The json body of the result, bytes or str.
+    """
+
+    __slots__ = ("response_code", "sha256", "file_name", "file_type", "sandbox_type", "submit_time",
+                 "threat_level", "threat_score", "multi_engines", "tags")
+    FIELDS = __slots__
+
+    def _load(self, data):
+        summary = (data.get("data") or {}).get("summary") or {}
+        tag = summary.get("tag") or {}
+        self.response_code = data.get("response_code")
+        self.sha256 = summary.get("sample_sha256")
+        self.file_name = summary.get("file_name")
+        self.file_type = _intern(summary.get("file_type"))
+        self.sandbox_type = _intern(summary.get("sandbox_type"))
+        self.submit_time = summary.get("submit_time")
+        self.threat_level = _intern(summary.get("threat_level"))
+        self.threat_score = summary.get("threat_score")
+        self.multi_engines = summary.get("multi_engines")
+        self.tags = _strings(tag.get("s")) + _strings(tag.get("x")) if isinstance(tag, dict) else _strings(tag)
+
+    def __repr__(self):
+        return "<SandboxSummary %s>" % self.sha256
+
+
+def reputations(result, view="now"):
+    """Split the result of IpReputation.get_all into ReputationResult objects.
+
+    :param result: The result of IpReputation.get_all for one or more IPs.
+    :param view: "now" for the current valid information, "expired" for the
+        expired intelligence information.
+    :return: Returns a dict of the ReputationResult of each IP.
+    """
+    if isinstance(result, (bytes, str)):
+        result = loads(result)
+    models = {}
+    for ip, item in (result.get("data") or {}).items():
+        if isinstance(item, dict) and view in item:
+            item = item[view]
+        models[ip] = ReputationResult(_compact(item))
+    return models
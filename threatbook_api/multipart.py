@@ -0,0 +1,116 @@
+# -*- coding:utf-8 -*-
+import hashlib
+import io
+import os
+import uuid
+
+CHUNK_SIZE = 64 * 1024
+
+# The escapes of a quoted parameter of Content-Disposition, those of the HTML
+# standard used by browsers and urllib3, so a file name cannot end the header.
+_ESCAPES = {ord('"'): "%22", ord("\r"): "%0D", ord("\n"): "%0A"}
+
+
+def file_size(fileobj):
+    """Return the number of bytes left in a seekable file object, or None."""
+    try:
+        position = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell() - position
+        fileobj.seek(position)
+        return size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def _quote(value):
+    """Return a name or file name escaped for a quoted parameter of a Content-Disposition header."""
+    return str(value).translate(_ESCAPES)
+
+
+def hash_file(fileobj, chunk_size=CHUNK_SIZE):
+    """Return the sha256 of the rest of a seekable file object and rewind it."""
+    position = fileobj.tell()
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        sha256.update(chunk)
+    fileobj.seek(position)
+    return sha256.hexdigest()
+
+
+class MultipartStream(object):
+    """A multipart/form-data body with one file, produced in chunks as it is sent.
+
+    The file is read chunk by chunk while the request is sent instead of being
+    encoded in memory first, and its sha256 is computed in the same pass. When
+    the size of the file is known the body has a length and is sent with a
+    Content-Length header, otherwise requests sends it chunked.
+
+    Attributes:
+        :param fields: The form fields sent before the file, a dict.
+        :param name: The name of the file field.
+        :param filename: The file name sent to the server, with its quotes and line breaks escaped.
+        :param fileobj: The binary file object to send, read from its current position.
+        :param chunk_size: The number of bytes read from the file at a time.
+    """
+
+    def __init__(self, fields, name, filename, fileobj, chunk_size=CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=%s" % self.boundary
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        parts = []
+        for key, value in fields.items():
+            parts.append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                         % (self.boundary, _quote(key), value))
+        parts.append('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'
+                     % (self.boundary, _quote(name), _quote(filename)))
+        self._head = "".join(parts).encode("utf-8")
+        self._tail = ("\r\n--%s--\r\n" % self.boundary).encode("utf-8")
+        size = file_size(fileobj)
+        self._length = None if size is None else len(self._head) + size + len(self._tail)
+        self._sha256 = hashlib.sha256()
+        self._chunks = self._generate()
+        self._buffer = b""
+        self._offset = 0
+
+    @property
+    def sha256(self):
+        """The sha256 of the file part sent so far, i.e. of the whole file once sent."""
+        return self._sha256.hexdigest()
+
+    def __bool__(self):
+        return True
+
+    def __len__(self):
+        if self._length is None:
+            raise TypeError("the length of the file is unknown")
+        return self._length
+
+    def _generate(self):
+        yield self._head
+        for chunk in iter(lambda: self.fileobj.read(self.chunk_size), b""):
+            self._sha256.update(chunk)
+            yield chunk
+        yield self._tail
+
+    def __iter__(self):
+        if self._offset < len(self._buffer):
+            yield self._buffer[self._offset:]
+        self._buffer, self._offset = b"", 0
+        for chunk in self._chunks:
+            yield chunk
+
+    def read(self, size=-1):
+        """Return at most size bytes of the body, fewer at the end of a chunk, b"" at the end."""
+        if size is None or size < 0:
+            return b"".join(self)
+        while self._offset >= len(self._buffer):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return b""
+            self._buffer, self._offset = chunk, 0
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
@@ -0,0 +1,263 @@
+# -*- coding:utf-8 -*-
+import asyncio
+import calendar
+import multiprocessing
+import threading
+import time
+from urllib.parse import urlparse
+
+LOW = "low"
+NORMAL = "normal"
+
+# Requests per second allowed by path prefix of the endpoint.
+DEFAULT_RATES = {
+    "/api/v1/domain/query": 5,
+    "/api/v1/ip/query": 5,
+    "/api/v2/ip_reputation": 5,
+    "/api/v2/file/report": 5,
+}
+
+
+class QuotaExceeded(Exception):
+    """Raised instead of sending a request that would go over the daily quota."""
+
+
+class TokenBucket(object):
+    """Token bucket that spaces requests evenly at rate per second.
+
+    Tokens are reserved in order, so waiting callers are served first come,
+    first served and sleep exactly until their turn.
+
+    Attributes:
+        :param rate: The number of tokens added per second.
+        :param capacity: The maximum number of tokens, i.e. the size of a burst.
+            The default is the rate, with a minimum of 1.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return the number of seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+
+class SharedTokenBucket(object):
+    """Token bucket whose tokens are kept in shared memory, so that the processes
+    it is passed to on their creation draw from the same budget.
+
+    Attributes:
+        :param rate: The number of tokens added per second.
+        :param capacity: The maximum number of tokens, see TokenBucket.
+        :param context: The multiprocessing context of the processes, the default is
+            the multiprocessing module.
+    """
+
+    def __init__(self, rate, capacity=None, context=None):
+        context = context or multiprocessing
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        # The tokens and the time they were counted at. time.monotonic is
+        # system-wide, so the processes agree on it.
+        self._state = context.RawArray("d", [self.capacity, time.monotonic()])
+        self._lock = context.Lock()
+
+    def reserve(self):
+        """Take a token and return the number of seconds to wait before using it."""
+        state = self._state
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.capacity, state[0] + (now - state[1]) * self.rate) - 1
+            state[0], state[1] = tokens, now
+        if tokens >= 0:
+            return 0
+        return -tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+
+class DailyQuota(object):
+    """Count of the requests of one API key against its daily quota.
+
+    The count restarts at midnight UTC. Low priority requests are refused
+    once the remaining quota falls to the reserve, so that the last part of
+    the quota stays available to normal requests.
+
+    Attributes:
+        :param limit: The number of requests allowed per day.
+        :param reserve: The part of the quota kept for normal requests, 0.1 by default.
+    """
+
+    def __init__(self, limit, reserve=0.1):
+        self.limit = limit
+        self.reserve = reserve
+        self.used = 0
+        self._reset_at = self._next_midnight()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _next_midnight():
+        today = time.gmtime()[:3]
+        return calendar.timegm(today + (0, 0, 0)) + 24 * 3600
+
+    @property
+    def remaining(self):
+        with self._lock:
+            self._roll()
+            return self.limit - self.used
+
+    def _roll(self):
+        if time.time() >= self._reset_at:
+            self.used = 0
+            self._reset_at = self._next_midnight()
+
+    def admit(self, priority=NORMAL):
+        """Count a request and return 0, or return the seconds until the quota is reset."""
+        with self._lock:
+            self._roll()
+            floor = self.limit * self.reserve if priority == LOW else 0
+            if self.limit - self.used > floor:
+                self.used += 1
+                return 0
+            return max(0.0, self._reset_at - time.time())
+
+
+class RateLimiter(object):
+    """Client side rate limits and daily quotas, kept separately for every API key.
+
+    Pass one limiter to the Client shared by the query classes, so all the
+    classes using the same API key draw from the same buckets. Requests wait
+    for their token instead of being sent and throttled by the server.
+
+    Attributes:
+        :param rate: The requests per second of the endpoints not in rates.
+        :param rates: The requests per second by path prefix of the endpoint,
+            the default is DEFAULT_RATES.
+        :param burst: The size of a burst of every bucket, the default is its rate.
+        :param daily_quota: The number of requests allowed per day and API key,
+            None for no quota.
+        :param reserve: The part of the daily quota low priority requests may not use.
+        :param when_exhausted: "raise" to raise QuotaExceeded when a request is over
+            the quota, "wait" to hold it until the quota is reset.
+    """
+
+    def __init__(self, rate=10, rates=None, burst=None, daily_quota=None, reserve=0.1, when_exhausted="raise"):
+        if when_exhausted not in ("raise", "wait"):
+            raise ValueError('when_exhausted must be "raise" or "wait"')
+        self.rate = rate
+        self.rates = DEFAULT_RATES if rates is None else rates
+        self.burst = burst
+        self.daily_quota = daily_quota
+        self.reserve = reserve
+        self.when_exhausted = when_exhausted
+        self._buckets = {}
+        self._quotas = {}
+        self._lock = threading.Lock()
+
+    def _prefix(self, url):
+        path = urlparse(url).path
+        best = None
+        for prefix in self.rates:
+            if path.startswith(prefix) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        return best
+
+    def bucket(self, api_key, url):
+        """Return the token bucket of the API key for the endpoint."""
+        prefix = self._prefix(url)
+        with self._lock:
+            bucket = self._buckets.get((api_key, prefix))
+            if bucket is None:
+                rate = self.rate if prefix is None else self.rates[prefix]
+                bucket = self._buckets[(api_key, prefix)] = TokenBucket(rate, self.burst)
+            return bucket
+
+    def quota(self, api_key):
+        """Return the DailyQuota of the API key, or None without a daily quota."""
+        if self.daily_quota is None:
+            return None
+        with self._lock:
+            quota = self._quotas.get(api_key)
+            if quota is None:
+                quota = self._quotas[api_key] = DailyQuota(self.daily_quota, self.reserve)
+            return quota
+
+    def _admit(self, api_key, priority):
+        quota = self.quota(api_key)
+        if quota is None:
+            return 0
+        wait = quota.admit(priority)
+        if wait and self.when_exhausted == "raise":
+            raise QuotaExceeded("daily quota of the API key is used up for %s priority requests" % priority)
+        return wait
+
+    def acquire(self, api_key, url, priority=NORMAL):
+        """Block until the request may be sent."""
+        wait = self._admit(api_key, priority)
+        while wait:
+            time.sleep(wait)
+            wait = self._admit(api_key, priority)
+        self.bucket(api_key, url).acquire()
+
+    async def acquire_async(self, api_key, url, priority=NORMAL):
+        """Wait without blocking the event loop until the request may be sent."""
+        wait = self._admit(api_key, priority)
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._admit(api_key, priority)
+        wait = self.bucket(api_key, url).reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class SharedRateLimiter(RateLimiter):
+    """RateLimiter whose buckets are shared by several processes, see ShardedRunner.
+
+    The buckets of every endpoint are created at once in shared memory, so the
+    limiter must be created before the processes and passed to them when they
+    are created. All the API keys draw from the same buckets, and there is no
+    daily quota.
+
+    Attributes:
+        :param rate: The requests per second of the endpoints not in rates.
+        :param rates: The requests per second by path prefix of the endpoint,
+            the default is DEFAULT_RATES.
+        :param burst: The size of a burst of every bucket, the default is its rate.
+        :param context: The multiprocessing context of the processes.
+    """
+
+    def __init__(self, rate=10, rates=None, burst=None, context=None):
+        super(SharedRateLimiter, self).__init__(rate, rates, burst)
+        self._shared = dict((prefix, SharedTokenBucket(value, burst, context)) for prefix, value in self.rates.items())
+        self._shared[None] = SharedTokenBucket(rate, burst, context)
+
+    def bucket(self, api_key, url):
+        return self._shared[self._prefix(url)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
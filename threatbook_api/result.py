@@ -0,0 +1,73 @@
+# -*- coding:utf-8 -*-
+import json
+import re
+
+from threatbook_api.decoder import loads
+from threatbook_api.instrument import timed_decode
+
+_APIKEY = re.compile(r"(apikey=)[^&\s'\"]+", re.IGNORECASE)
+
+
+class Result(dict):
+    """Decoded response of a query in typed mode.
+
+    It is the dict the query returns on success, and in typed mode errors are
+    returned the same way instead of as a json string, so callers never have
+    to check the type or parse again. The body received from the server stays
+    available in raw, for callers that only forward it.
+
+    Attributes:
+        :param raw: The response body as bytes, None for results built by the client.
+        :param status_code: The HTTP status code, None when no response was received.
+    """
+
+    __slots__ = ("raw", "status_code")
+
+    def __init__(self, data=(), raw=None, status_code=None):
+        super(Result, self).__init__(data)
+        self.raw = raw
+        self.status_code = status_code
+
+    def copy(self):
+        return Result(self, self.raw, self.status_code)
+
+    @property
+    def ok(self):
+        """Whether the request and the query succeeded."""
+        return self.status_code in (None, 200) and self.get("response_code") == 0
+
+
+def decode(response, typed=False, fields=None):
+    """Decode the body of a response from its bytes, into a Result in typed mode.
+
+    :param fields: The top-level fields to keep, the default keeps all of them.
+    """
+    if typed:
+        return timed_decode(response, lambda: Result(loads(response.content, fields), response.content,
+                                                     response.status_code))
+    return timed_decode(response, lambda: loads(response.content, fields))
+
+
+def encode(res, typed=False, status_code=None, raw=None):
+    """Return a result built by the client: a Result in typed mode, a json string otherwise.
+
+    :param raw: The body of the response res was built from, if any.
+    """
+    if typed:
+        return Result(res, raw, status_code)
+    return json.dumps(res)
+
+
+def redact(text):
+    """Return text with the value of every apikey parameter, e.g. of a URL in an error, replaced by ***."""
+    return _APIKEY.sub(r"\1***", text)
+
+
+def failure(error, typed=False):
+    """Return the result of a request that raised error: a Result in typed mode, None otherwise.
+
+    The message of the error is redacted, since the URL of a GET request holds the API key.
+    """
+    if typed:
+        return Result({"data": {}, "msg": redact(str(error)), "response_code": -4})
+    return None
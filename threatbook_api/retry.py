@@ -0,0 +1,137 @@
+# -*- coding:utf-8 -*-
+import asyncio
+import random
+import threading
+import time
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Connection errors and timeouts of the blocking and the async clients.
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, ConnectionError, asyncio.TimeoutError)
+if aiohttp is not None:
+    RETRY_EXCEPTIONS += (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class Retry(object):
+    """Retry policy of the requests with exponential backoff and jitter.
+
+    A request is sent again when it raises one of the exceptions or returns one
+    of the status codes, until max_attempts requests were sent or the next one
+    would start after the deadline. The number of retries and of requests that
+    failed after the last attempt are counted in retries and giveups.
+
+    Attributes:
+        :param max_attempts: The maximum number of requests sent, 1 disables retries.
+        :param backoff: The delay in seconds before the first retry, doubled for every
+            following one.
+        :param max_backoff: The maximum delay in seconds between two attempts.
+        :param jitter: Whether the delay is drawn at random between 0 and its value,
+            which keeps clients that failed together from retrying together.
+        :param status_forcelist: The HTTP status codes that are retried.
+        :param exceptions: The exception classes that are retried.
+        :param deadline: The maximum time in seconds spent on a request and its
+            retries, None for no limit.
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=30, jitter=True, status_forcelist=RETRY_STATUS,
+                 exceptions=RETRY_EXCEPTIONS, deadline=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.status_forcelist = status_forcelist
+        self.exceptions = exceptions
+        self.deadline = deadline
+        self.retries = 0
+        self.giveups = 0
+        self._lock = threading.Lock()
+
+    def delay(self, attempt):
+        """Return the delay in seconds before the retry following the attempt."""
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def _next_delay(self, attempt, start):
+        # None when there is no attempt left.
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.delay(attempt)
+        if self.deadline is not None and time.monotonic() - start + delay >= self.deadline:
+            return None
+        return delay
+
+    def _count(self, retried):
+        with self._lock:
+            if retried:
+                self.retries += 1
+            else:
+                self.giveups += 1
+
+    def call(self, func):
+        """Call func until it returns a response that is not retried, or no attempt is left."""
+        start = time.monotonic()
+        attempt = 1
+        while True:
+            try:
+                response = func()
+            except self.exceptions:
+                delay = self._next_delay(attempt, start)
+                if delay is None:
+                    self._count(False)
+                    raise
+            else:
+                if response.status_code not in self.status_forcelist:
+                    return response
+                delay = self._next_delay(attempt, start)
+                if delay is None:
+                    self._count(False)
+                    return response
+            self._count(True)
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, func):
+        """Coroutine version of call, func returns an awaitable."""
+        start = time.monotonic()
+        attempt = 1
+        while True:
+            try:
+                response = await func()
+            except self.exceptions:
+                delay = self._next_delay(attempt, start)
+                if delay is None:
+                    self._count(False)
+                    raise
+            else:
+                if response.status_code not in self.status_forcelist:
+                    return response
+                delay = self._next_delay(attempt, start)
+                if delay is None:
+                    self._count(False)
+                    return response
+            self._count(True)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        """Return the number of retries and of requests given up."""
+        return {"retries": self.retries, "giveups": self.giveups}
+
+    def __getstate__(self):
+        # A policy can be passed to other processes, e.g. by ShardedRunner.
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
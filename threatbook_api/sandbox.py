@@ -0,0 +1,183 @@
+# -*- coding:utf-8 -*-
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger("threatbook_api")
+
+
+class SandboxTimeout(Exception):
+    """Raised by the future of a file whose report was not ready before the timeout."""
+
+
+class UploadError(Exception):
+    """Raised by the future of a file whose upload failed, with the error result of the upload."""
+
+    def __init__(self, msg, result=None):
+        super(UploadError, self).__init__(msg)
+        self.result = result
+
+
+class _Sample(object):
+
+    def __init__(self, sha256, deadline):
+        self.sha256 = sha256
+        self.deadline = deadline
+        self.interval = None
+        self.waiters = []
+
+
+class SandboxPipeline(object):
+    """Upload files to the sandbox and deliver their reports once the analysis is done.
+
+    Files are uploaded concurrently. Each uploaded sample is then polled with
+    Report.get_summary: the first check waits for the sandbox run time, and
+    the following ones back off from a quarter of it up to max_interval.
+    All the samples due at the same moment are checked together in one round,
+    and files with the same sha256 share their checks. A report is delivered
+    through the future returned by submit, and through the callback if one
+    is given.
+
+    Attributes:
+        :param upload: The Upload object used to send the files.
+        :param report: The Report object used to poll and fetch the reports.
+        :param workers: The number of uploads and status checks run at the same time.
+        :param fetch: Called with the sha256 of a finished sample to get the delivered
+            report, the default delivers the summary that reported the end of the analysis.
+        :param callback: Called with (file, report) for every delivered report.
+        :param max_interval: The maximum number of seconds between two checks of a sample.
+        :param timeout: The number of seconds after the upload before a sample is given up.
+    """
+
+    def __init__(self, upload, report, workers=4, fetch=None, callback=None, max_interval=120, timeout=1800):
+        self.upload = upload
+        self.report = report
+        self.fetch = fetch
+        self.callback = callback
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._samples = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._poller = threading.Thread(target=self._poll_loop, name="sandbox-poller")
+        self._poller.daemon = True
+        self._poller.start()
+
+    def submit(self, file):
+        """Upload a file and return a Future of its report."""
+        future = Future()
+        future.file = file
+        self._executor.submit(self._upload, file, future)
+        return future
+
+    def submit_many(self, files):
+        """Upload files and return the list of the futures of their reports."""
+        return [self.submit(file) for file in files]
+
+    def iter_reports(self, files):
+        """Upload files and yield (file, report) tuples as the reports are ready."""
+        for future in as_completed(self.submit_many(files)):
+            yield future.file, future.result()
+
+    def _upload(self, file, future):
+        try:
+            ret_json = self.upload.upload_file(file)
+            if isinstance(ret_json, str):
+                ret_json = json.loads(ret_json)
+            if not isinstance(ret_json, dict) or ret_json.get("response_code") != 0:
+                msg = ret_json.get("msg") if isinstance(ret_json, dict) else "the request failed"
+                raise UploadError("upload of %s failed: %s" % (file, msg), ret_json)
+            sha256 = ret_json["data"]["sha256"]
+        except Exception as e:
+            future.set_exception(e)
+            return
+        with self._cond:
+            sample = self._samples.get(sha256)
+            if sample is None:
+                sample = self._samples[sha256] = _Sample(sha256, time.time() + self.timeout)
+                first_check = max(1, self.upload.run_time)
+                heapq.heappush(self._heap, (time.time() + first_check, next(self._counter), sample))
+                self._cond.notify()
+            sample.waiters.append(future)
+
+    def _poll_loop(self):
+        while True:
+            with self._cond:
+                while not self._closed and (not self._heap or self._heap[0][0] > time.time()):
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                if self._closed:
+                    return
+                due = []
+                while self._heap and self._heap[0][0] <= time.time():
+                    due.append(heapq.heappop(self._heap)[2])
+            for sample in due:
+                self._executor.submit(self._check, sample)
+
+    def _check(self, sample):
+        try:
+            summary = self.report.get_summary(sample.sha256)
+        except Exception:
+            summary = None
+        if isinstance(summary, dict) and summary.get("response_code") == 0:
+            try:
+                result = summary if self.fetch is None else self.fetch(sample.sha256)
+            except Exception as e:
+                self._finish(sample, error=e)
+            else:
+                self._finish(sample, result=result)
+            return
+        if time.time() >= sample.deadline:
+            self._finish(sample, error=SandboxTimeout("no report for %s after %ss" % (sample.sha256, self.timeout)))
+            return
+        if sample.interval is None:
+            sample.interval = max(5, self.upload.run_time / 4.0)
+        else:
+            sample.interval = min(self.max_interval, sample.interval * 2)
+        with self._cond:
+            heapq.heappush(self._heap, (time.time() + sample.interval, next(self._counter), sample))
+            self._cond.notify()
+
+    def _finish(self, sample, result=None, error=None):
+        with self._cond:
+            self._samples.pop(sample.sha256, None)
+            waiters = sample.waiters
+        for future in waiters:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+                continue
+            future.set_result(result)
+            if self.callback is not None:
+                try:
+                    self.callback(future.file, result)
+                except Exception:
+                    logger.exception("sandbox callback for %s failed", sample.sha256)
+
+    def close(self):
+        """Stop polling, wait for the running uploads and checks, and cancel the futures still waiting for a report."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._poller.join()
+        self._executor.shutdown()
+        with self._cond:
+            samples = list(self._samples.values())
+            self._samples.clear()
+            del self._heap[:]
+        for sample in samples:
+            for future in sample.waiters:
+                future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,216 @@
+# -*- coding:utf-8 -*-
+"""Lookups of large indicator backlogs spread over several processes.
+
+One Python process spends much of a bulk run holding the GIL to decode the
+responses and post-process them, so its throughput stops growing with the
+number of threads. ShardedRunner splits the input into shards by a hash of
+the indicator and runs every shard in its own process, with its own pooled
+Client and threads, while a SharedRateLimiter keeps all the processes under
+the rate of the API key. The results are merged back into one stream.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from threatbook_api.client import Client
+from threatbook_api.result import failure
+
+
+def shard(indicator, shards):
+    """Return the shard of an indicator, the same in every process and run."""
+    return zlib.crc32(indicator.encode("utf-8")) % shards
+
+
+class Lookup(object):
+    """Picklable factory of the lookup of a query class, for ShardedRunner.
+
+    Lookup(IpAnalysis, api_key, "get_all") creates IpAnalysis(api_key, client=client)
+    in every worker process and looks the indicators up with its get_all.
+
+    Attributes:
+        :param query_class: The query class, such as IpAnalysis or DomainAnalysis.
+        :param api_key: The API key passed to the query class.
+        :param method: The name of the method called with each indicator.
+        :param options: Other keyword arguments of the query class, such as typed=True.
+    """
+
+    def __init__(self, query_class, api_key, method="get_all", **options):
+        self.query_class = query_class
+        self.api_key = api_key
+        self.method = method
+        self.options = options
+
+    def __call__(self, client):
+        return getattr(self.query_class(self.api_key, client=client, **self.options), self.method)
+
+
+def _work(factory, workers, client_options, tasks, results):
+    # The main thread of a worker process hands the indicators of its task queue
+    # to a thread pool, each thread sends its result to the results queue. The
+    # processes share the stdout of the parent, so nothing is printed.
+    client = Client(pool_maxsize=workers, **client_options)
+    func = factory(client)
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def lookup(seq, indicator):
+        try:
+            try:
+                result = func(indicator)
+            except Exception as e:
+                result = failure(repr(e), typed=True)
+            results.put((seq, indicator, result))
+        finally:
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch in iter(tasks.get, None):
+                for seq, indicator in batch:
+                    slots.acquire()
+                    executor.submit(lookup, seq, indicator)
+    finally:
+        client.close()
+
+
+class ShardedRunner(object):
+    """Look up indicators in several processes, each with its own client.
+
+    An indicator always goes to the process of its shard, so a cache or the
+    single flight of the client of that process also deduplicates the
+    indicators repeated in the input. The indicators are read lazily and at
+    most window of them are in flight or waiting to be yielded, so the memory
+    used does not grow with the input.
+
+    Attributes:
+        :param factory: A picklable callable called in every worker process with its
+            Client and returning the function looking up one indicator, such as
+            Lookup(IpAnalysis, api_key, "get_all").
+        :param processes: The number of worker processes, the default is the number of CPUs.
+        :param workers: The number of lookups run at the same time by every process.
+        :param rate_limiter: A SharedRateLimiter shared by the clients of all the processes.
+        :param client_options: Other keyword arguments of the Client of every process,
+            such as timeout, retry or base_url.
+        :param window: The maximum number of indicators in flight, the default is four
+            times the number of lookups run at the same time.
+        :param batch_size: The number of indicators sent to a process at a time.
+        :param context: The multiprocessing context, or the name of its start method
+            such as "spawn". With spawn the factory must be importable.
+    """
+
+    def __init__(self, factory, processes=None, workers=8, rate_limiter=None, client_options=None, window=None,
+                 batch_size=16, context=None):
+        if isinstance(context, str) or context is None:
+            context = multiprocessing.get_context(context)
+        self.factory = factory
+        self.processes = processes or os.cpu_count() or 1
+        self.workers = workers
+        self.client_options = dict(client_options or {})
+        if rate_limiter is not None:
+            self.client_options["rate_limiter"] = rate_limiter
+        self.window = window or self.processes * workers * 4
+        self.batch_size = batch_size
+        self.context = context
+
+    def _feed(self, indicators, tasks, window, state):
+        # Assign a sequence number to every indicator and send them to the task
+        # queues of their shards in batches. A batch is sent when it is full, or
+        # when the window is full so that no indicator waits in a partial batch.
+        batches = [[] for _ in tasks]
+
+        def flush():
+            for i, batch in enumerate(batches):
+                if batch:
+                    tasks[i].put(batch)
+                    batches[i] = []
+
+        try:
+            for indicator in indicators:
+                if not window.acquire(False):
+                    flush()
+                    while not window.acquire(timeout=0.5):
+                        if state["stop"]:
+                            return
+                if state["stop"]:
+                    return
+                i = shard(indicator, len(tasks))
+                batches[i].append((state["sent"], indicator))
+                state["sent"] += 1
+                if len(batches[i]) >= self.batch_size:
+                    tasks[i].put(batches[i])
+                    batches[i] = []
+        except Exception as e:
+            state["error"] = e
+        finally:
+            if not state["stop"]:
+                flush()
+            for task_queue in tasks:
+                task_queue.put(None)
+            state["done"] = True
+
+    def run(self, indicators, ordered=True):
+        """Look up an iterable of indicators.
+
+        :param indicators: An iterable of indicator strings.
+        :param ordered: Whether the results are yielded in the order of the input,
+            the default. With False they are yielded as soon as they are received.
+        :return: Yields (indicator, result) tuples. When the lookup raised, the result
+            is a Result with response_code -4 and the repr of the exception in msg.
+            Raises RuntimeError when a worker process exits before the end.
+        """
+        tasks = [self.context.Queue() for _ in range(self.processes)]
+        results = self.context.Queue()
+        processes = [self.context.Process(target=_work, daemon=True,
+                                          args=(self.factory, self.workers, self.client_options, task_queue, results))
+                     for task_queue in tasks]
+        for process in processes:
+            process.start()
+        window = threading.Semaphore(self.window)
+        state = {"sent": 0, "done": False, "stop": False, "error": None}
+        feeder = threading.Thread(target=self._feed, args=(indicators, tasks, window, state))
+        feeder.daemon = True
+        feeder.start()
+        finished = False
+        try:
+            received = 0
+            pending = {}
+            next_seq = 0
+            while not state["done"] or received < state["sent"]:
+                try:
+                    seq, indicator, result = results.get(timeout=0.5)
+                except queue.Empty:
+                    # A worker process only exits by itself once its shard is done.
+                    for process in processes:
+                        if process.exitcode not in (None, 0):
+                            raise RuntimeError("a worker process exited with code %s" % process.exitcode)
+                    if all(process.exitcode is not None for process in processes):
+                        raise RuntimeError("the worker processes exited before returning all the results")
+                    continue
+                received += 1
+                if not ordered:
+                    window.release()
+                    yield indicator, result
+                    continue
+                pending[seq] = (indicator, result)
+                while next_seq in pending:
+                    item = pending.pop(next_seq)
+                    next_seq += 1
+                    window.release()
+                    yield item
+            if state["error"] is not None:
+                raise state["error"]
+            finished = True
+        finally:
+            # The feeder may be blocked reading the input, it stops at the next
+            # indicator once stop is set.
+            state["stop"] = True
+            for process in processes:
+                if finished:
+                    process.join()
+                else:
+                    process.terminate()
+            if not finished:
+                for task_queue in tasks:
+                    task_queue.cancel_join_thread()
@@ -0,0 +1,80 @@
+# -*- coding:utf-8 -*-
+import asyncio
+import threading
+
+from threatbook_api.cache import cache_key
+
+
+def flight_key(method, url, params):
+    """Return the key under which identical requests share one call.
+
+    It is the cache_key of the request and its API key. Requests sent with
+    different API keys are never shared, since an invalid key or quota error
+    belongs to one key, and so does the request counted by the rate limiter.
+    """
+    return cache_key(method, url, params), params.get("apikey")
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Share one call between the threads asking for the same key at the same time.
+
+    The first thread runs the function, the threads arriving while it is in
+    flight wait for it and get the same result, or the same exception raised.
+    The number of calls answered that way is kept in the shared attribute.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class AsyncSingleFlight(object):
+    """Share one call between the coroutines awaiting the same key at the same time."""
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+
+    async def do(self, key, func):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+        # A waiter being cancelled must not cancel the call of the others.
+        return await asyncio.shield(task)
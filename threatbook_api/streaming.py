@@ -0,0 +1,169 @@
+# -*- coding:utf-8 -*-
+"""Incremental parsing of the items of one array in a large json document.
+
+A sandbox report section can hold tens of thousands of events. ItemParser is
+fed the body chunk by chunk as it is downloaded and hands out each item of the
+wanted array as soon as the item is complete, so only one item is held in
+memory at a time and the items can be processed before the download ends.
+"""
+import re
+
+from threatbook_api.decoder import loads
+
+# The top-level fields kept by ItemParser.status.
+STATUS_FIELDS = ("response_code", "msg", "verbose_msg")
+
+_TOKENS = re.compile(rb'[\\"\[\]{},:]')
+_QUOTE, _BACKSLASH, _COLON, _COMMA = ord('"'), ord("\\"), ord(":"), ord(",")
+_OPENERS = (ord("{"), ord("["))
+
+
+class StreamError(Exception):
+    """Raised when a streamed report is missing or reported as an error."""
+
+    def __init__(self, msg, response_code=None):
+        super(StreamError, self).__init__(msg)
+        self.response_code = response_code
+
+
+def split_path(path):
+    """Return a path given as a dotted string or a list as a list of keys."""
+    if not path:
+        return []
+    if isinstance(path, str):
+        return path.split(".")
+    return list(path)
+
+
+class ItemParser(object):
+    """Incremental parser of the array or object found at a path of keys.
+
+    Items of an array are yielded as they are; the members of an object are
+    yielded as (key, value) tuples. The top-level status fields of the document
+    are kept in status whatever their place in the document.
+
+    Attributes:
+        :param path: The keys leading from the root object to the array, as a
+            dotted string such as "data.network.tcp" or a list.
+    """
+
+    def __init__(self, path):
+        self.path = split_path(path)
+        self.depth = len(self.path) + 1
+        self.status = {}
+        self.found = False
+        self.done = False
+        # One frame per open container: [is object, current key, expecting a key].
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._key = None
+        self._capture = None
+        self._capture_depth = None
+        self._capture_key = None
+        self._capture_item = False
+
+    def _is_target(self):
+        stack = self._stack
+        return (not self.found and len(stack) == len(self.path)
+                and all(frame[0] for frame in stack) and [frame[1] for frame in stack] == self.path)
+
+    def _start(self, depth, key, item):
+        self._capture = bytearray()
+        self._capture_depth, self._capture_key, self._capture_item = depth, key, item
+
+    def _finish(self, data, items):
+        capture, key = self._capture, self._capture_key
+        self._capture = None
+        capture += data
+        if not capture.strip():
+            return
+        value = loads(bytes(capture))
+        if self._capture_depth == 1 and key in STATUS_FIELDS:
+            self.status[key] = value
+        if not self._capture_item:
+            return
+        items.append(value if key is None else (key, value))
+
+    def feed(self, chunk):
+        """Parse the next chunk of the document and return the list of the items completed in it."""
+        items = []
+        stack = self._stack
+        start = 0
+        if self._escape:
+            self._escape = False
+            start = 1
+        skip = start
+        key_from = 0 if self._key is not None else None
+        capture_from = 0 if self._capture is not None else None
+        for match in _TOKENS.finditer(chunk, start):
+            i = match.start()
+            if i < skip:
+                continue
+            c = chunk[i]
+            if self._in_string:
+                if c == _BACKSLASH:
+                    skip = i + 2
+                    if skip > len(chunk):
+                        self._escape = True
+                elif c == _QUOTE:
+                    self._in_string = False
+                    if self._key is not None:
+                        self._key += chunk[key_from:i]
+                        stack[-1][1] = loads(b'"' + bytes(self._key) + b'"')
+                        self._key, key_from = None, None
+                continue
+            if c == _QUOTE:
+                self._in_string = True
+                if stack and stack[-1][0] and stack[-1][2] and len(stack) <= self.depth:
+                    self._key, key_from = bytearray(), i + 1
+            elif c in _OPENERS:
+                target = self._is_target()
+                stack.append([c == _OPENERS[0], None, True])
+                if target:
+                    self.found = True
+                    if not stack[-1][0]:
+                        self._start(len(stack), None, True)
+                        capture_from = i + 1
+            elif c == _COLON:
+                frame = stack[-1]
+                frame[2] = False
+                depth = len(stack)
+                item = self.found and not self.done and depth == self.depth
+                if self._capture is None and (item or (depth == 1 and frame[1] in STATUS_FIELDS)):
+                    self._start(depth, frame[1], item)
+                    capture_from = i + 1
+            else:
+                depth = len(stack)
+                if self._capture is not None and depth == self._capture_depth:
+                    self._finish(chunk[capture_from:i], items)
+                    capture_from = None
+                if c == _COMMA:
+                    frame = stack[-1]
+                    if frame[0]:
+                        frame[2] = True
+                    elif self.found and not self.done and depth == self.depth:
+                        self._start(depth, None, True)
+                        capture_from = i + 1
+                else:
+                    stack.pop()
+                    if self.found and depth == self.depth:
+                        self.done = True
+        if self._key is not None:
+            self._key += chunk[key_from:]
+        if self._capture is not None:
+            self._capture += chunk[capture_from:]
+        return items
+
+
+def iter_items(chunks, path):
+    """Yield the items of the array at path of a json document read in chunks.
+
+    :param chunks: An iterable of bytes, e.g. response.iter_content(65536) or
+        iter(lambda: f.read(65536), b"").
+    :param path: The keys leading from the root object to the array.
+    """
+    parser = ItemParser(path)
+    for chunk in chunks:
+        for item in parser.feed(chunk):
+            yield item